@@ -0,0 +1,168 @@
+# Decoder Corpus
+# Realistic payloads for each module_libs decoder: small, large, no-match and adversarial cases
+#
+# Each entry of DECODERS is (library, function name, case builder), the builder returning {case name: payload}.
+# A library that can't be imported (lib8583 needs the iso8583 package) is skipped by the harness.
+
+import base64
+import json
+import random
+
+SOH = b'\x01'
+# Fixed seed, so every run (and every baseline) uses the same bytes
+rng = random.Random(8583)
+
+
+def noise(size):
+    # Random bytes with no 0x30, 0x06 or SOH, so no decoder finds anything in them
+    return bytes(rng.choice(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz \r\n') for _ in range(size))
+
+def http_request(headers, body=b''):
+    lines = [b'POST /api/v1/orders HTTP/1.1', b'Host: shop.example.com', b'User-Agent: Mozilla/5.0 (X11; Linux x86_64)',
+             b'Accept: application/json', b'Content-Type: application/json', b'Content-Length: %d' % len(body)]
+    return b'\r\n'.join(lines + headers) + b'\r\n\r\n' + body
+
+def json_body(size):
+    items = []
+    while sum(len(item) for item in items) < size:
+        items.append(json.dumps({'sku': rng.randrange(10 ** 8), 'qty': rng.randrange(1, 9), 'note': noise(24).decode()}).encode())
+    return b'[' + b','.join(items) + b']'
+
+
+def basic_auth_cases():
+    header = b'Authorization: Basic ' + base64.b64encode(b'alice:correct horse battery staple')
+    return {
+        'small': http_request([header]),
+        'large': http_request([header], json_body(64 * 1024)),
+        'nomatch': http_request([b'Cookie: session=' + noise(64)], json_body(4096)),
+        # Thousands of near-miss headers whose "base64" doesn't decode to user:password
+        'adversarial': b'\r\n'.join([b'Authorization: Basic ' + b'A' * 61 + b'='] * 2000),
+    }
+
+def smtp_auth_cases():
+    plain = base64.b64encode(b'\x00bob@example.com\x00hunter2')
+    session = [b'EHLO client.example.com', b'AUTH PLAIN ' + plain, b'MAIL FROM:<bob@example.com>', b'RCPT TO:<carol@example.com>', b'DATA']
+    return {
+        'small': b'AUTH PLAIN ' + plain + b'\r\n',
+        'large': b'\r\n'.join(session) + b'\r\n' + noise(64 * 1024) + b'\r\n.\r\n',
+        'nomatch': b'\r\n'.join(session[:1] + session[2:]) + b'\r\n' + noise(4096),
+        # AUTH LOGIN exchanges with long base64 runs for the patterns to scan and backtrack over
+        'adversarial': (b'AUTH LOGIN\r\n' + b'Q' * 512 + b'\r\n334 ' + b'x' * 64 + b'\r\n') * 100,
+    }
+
+def ldap_bind(dn, password, message_id=1):
+    def tlv(tag, value):
+        if len(value) < 0x80:
+            return bytes([tag, len(value)]) + value
+        length = len(value).to_bytes(4, 'big')
+        return bytes([tag, 0x84]) + length + value
+    bind = tlv(0x60, tlv(0x02, b'\x03') + tlv(0x04, dn) + tlv(0x80, password))
+    return tlv(0x30, tlv(0x02, bytes([message_id])) + bind)
+
+def ldap_search(message_id):
+    search = bytes([0x63, 0x2c]) + bytes([0x04, 0x11]) + b'dc=example,dc=com' + bytes([0x0a, 0x01, 0x02, 0x0a, 0x01, 0x00, 0x02, 0x01, 0x00,
+              0x02, 0x01, 0x00, 0x01, 0x01, 0x00, 0x87, 0x0b]) + b'objectClass' + bytes([0x30, 0x00])
+    return bytes([0x30, len(search) + 3, 0x02, 0x01, message_id]) + search
+
+def ldap_bind_cases():
+    bind = ldap_bind(b'cn=admin,dc=example,dc=com', b'S3cr3t!')
+    searches = b''.join(ldap_search(n % 100 + 2) for n in range(64 * 1024 // 50))
+    return {
+        'small': bind,
+        'large': searches + bind,
+        'nomatch': b''.join(ldap_search(n % 100 + 2) for n in range(4096 // 50)),
+        # Every byte starts a SEQUENCE with a long-form length and a bogus inner bind
+        'adversarial': b'\x30\x84\x7f\xff\xff\xff\x02\x84\x00\x00\x00\x01\x00\x60\x84\x00' * 4096,
+    }
+
+def jwt_token():
+    def part(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=')
+    header = part({'alg': 'RS256', 'typ': 'JWT', 'kid': 'k1'})
+    payload = part({'sub': '1234567890', 'name': 'Alice', 'iat': 1700000000, 'exp': 1900000000, 'scope': 'read write'})
+    return header + b'.' + payload + b'.' + base64.urlsafe_b64encode(noise(256)).rstrip(b'=')
+
+def jwt_cases():
+    header = b'Authorization: Bearer ' + jwt_token()
+    return {
+        'small': http_request([header]),
+        'large': http_request([header], json_body(64 * 1024)),
+        'nomatch': http_request([b'Cookie: session=' + noise(64)], json_body(4096)),
+        # Long dotted base64url runs after "token=" that almost look like JWTs
+        'adversarial': b'&'.join([b'token=' + b'eyJ' * 40 + b'.' + b'a' * 120] * 500),
+    }
+
+def fix_message(fields):
+    body = b''.join(b'%d=%s' % (tag, value) + SOH for tag, value in fields)
+    message = b'8=FIX.4.4' + SOH + b'9=%d' % len(body) + SOH + body
+    return message + b'10=%03d' % (sum(message) % 256) + SOH
+
+def fix_order(n):
+    return fix_message([(35, b'D'), (49, b'BUYSIDE'), (56, b'SELLSIDE'), (34, b'%d' % n), (52, b'20240101-12:00:00.000'),
+                        (11, b'ORD%06d' % n), (55, b'MSFT'), (54, b'1'), (38, b'100'), (40, b'2'), (44, b'412.50'), (59, b'0')])
+
+def fix_cases():
+    return {
+        'small': fix_order(1),
+        'large': b''.join(fix_order(n) for n in range(64 * 1024 // 160)),
+        'nomatch': noise(4096),
+        # Thousands of tiny fields, most of them without a value
+        'adversarial': (b'=' + SOH + b'35=' + SOH + b'x' + SOH) * 8192,
+    }
+
+def ebcdic(text):
+    return text.encode('cp037')
+
+def ebcdic_cases():
+    screen = ebcdic('WELCOME TO CICS - ENTER USERID AND PASSWORD'.ljust(80))
+    return {
+        'small': screen,
+        'large': screen * (64 * 1024 // 80),
+        'nomatch': bytes(range(256)) * 16,
+        # Unprintable bytes only, each of which expands to a six character escape
+        'adversarial': bytes([0x00, 0x01, 0x3f, 0xff]) * 16384,
+    }
+
+def solace_login(username, password):
+    return (b'\x03\x01\x00\x54\x01' + b'\x06' + bytes([len(username)]) + base64.b64encode(username) +
+            b'\x07' + bytes([len(password)]) + base64.b64encode(password) + b'\x81\x00\x00')
+
+def solace_cases():
+    login = solace_login(b'trader01', b'P@ssw0rd')
+    return {
+        'small': login,
+        'large': noise(64 * 1024) + login,
+        'nomatch': noise(4096),
+        # Markers present with long junk runs in place of the base64
+        'adversarial': b'\x06\x00' + b'!' * 32768 + b'\x07\x00' + b'!' * 32768 + b'\x81',
+    }
+
+def iso8583_cases():
+    import iso8583
+    from iso8583.specs import default_ascii as spec
+
+    def message(fields):
+        encoded, _ = iso8583.encode(dict(fields), spec)
+        return bytes(encoded)
+    base = {'t': '0200', '2': '4111111111111111', '3': '000000', '4': '000000010000', '7': '0101120000',
+            '11': '123456', '12': '120000', '41': 'TERM0001', '42': 'MERCHANT0000001', '49': '840'}
+    return {
+        'small': message(base),
+        'large': message(dict(base, **{'48': 'A' * 999, '62': 'B' * 999, '63': 'C' * 999})),
+        'nomatch': noise(512),
+        # A bitmap claiming every field, with truncated data
+        'adversarial': b'0200' + b'F' * 32 + b'9' * 64,
+    }
+
+
+# (library, function, case builder), in the order the report lists them
+DECODERS = [
+    ('lib_http_basic', 'format_basic_auth', basic_auth_cases),
+    ('lib_smtp_auth', 'format_smtp_auth', smtp_auth_cases),
+    ('lib_ldap_bind', 'format_ldap_bind', ldap_bind_cases),
+    ('lib_jwt', 'find_and_format_jwts', jwt_cases),
+    ('lib_fix', 'format_fix_message', fix_cases),
+    ('lib3270', 'ebcdic_to_ascii', ebcdic_cases),
+    ('solace_auth', 'decode_base64_credentials', solace_cases),
+    ('lib8583', 'decode_iso8583', iso8583_cases),
+]
@@ -0,0 +1,182 @@
+# Decoder Microbenchmarks
+# Times each module_libs decoder against the bench/decoder_corpus.py payloads and checks for regressions
+#
+# Usage: python bench/micro_bench.py [--filter lib_fix] [--quick] [--update] [--check] [--threshold 1.75]
+#
+# ns/op is the median of several timed runs. peak_alloc is the most memory one call had allocated at once, from tracemalloc.
+# --update stores the results in micro_baselines.json; --check exits non-zero when a case got slower (or allocates more)
+# than its baseline by more than --threshold. Each run of a case is paired with a run of a fixed reference workload, and
+# the median of the case / reference ratios is what gets compared, which takes out most of the machine, load and CPU
+# frequency differences, but not all of them: the default threshold sits above the run-to-run spread of a clean tree.
+
+import os
+import sys
+import json
+import statistics
+import time
+import argparse
+import platform
+import importlib
+import tracemalloc
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'module_libs'))
+
+from decoder_corpus import DECODERS
+
+BASELINES = os.path.join(BENCH_DIR, 'micro_baselines.json')
+# Default --check threshold: on a busy single-CPU machine the same tree varied by up to 1.55x between full runs
+THRESHOLD = 1.75
+
+
+def call_loop(function, payload, number):
+    # Decoders may raise on adversarial input, that is timed too
+    started = time.perf_counter_ns()
+    for _ in range(number):
+        try:
+            function(payload)
+        except Exception:
+            pass
+    return time.perf_counter_ns() - started
+
+def loop_size(function, payload, target):
+    """Calls that take about target seconds."""
+    number = 1
+    while True:
+        elapsed = call_loop(function, payload, number)
+        if elapsed >= 20_000_000 or number >= 1 << 20:
+            break
+        number *= 2
+    return max(1, int(number * target * 1e9 / max(elapsed, 1)))
+
+def time_case(function, payload, target, repeats):
+    """
+    Median ns/op of function and of the reference workload over repeats paired runs of about target seconds each,
+    and the median of their ratios, to factor out how fast this machine happens to be running right now.
+    """
+    number = loop_size(function, payload, target)
+    reference_number = loop_size(reference_workload, REFERENCE_PAYLOAD, target / 2)
+    samples = []
+    for _ in range(repeats):
+        reference = call_loop(reference_workload, REFERENCE_PAYLOAD, reference_number) / reference_number
+        ns = call_loop(function, payload, number) / number
+        samples.append((ns, reference))
+    return (statistics.median(ns for ns, _ in samples), statistics.median(reference for _, reference in samples),
+            statistics.median(ns / reference for ns, reference in samples))
+
+def reference_workload(payload):
+    # Plain interpreter work (loops, indexing, string building, dict lookups) for calibration
+    table = {byte: chr(byte) for byte in range(256)}
+    text = ''
+    for byte in payload:
+        text += table[byte]
+    return text.split('a')
+
+REFERENCE_PAYLOAD = bytes(range(256)) * 16
+
+def measure_allocations(function, payload):
+    """Peak bytes allocated during one call, and the exception it raised if any."""
+    error = None
+    # One call first, so one-off costs such as compiling regexes aren't counted
+    try:
+        function(payload)
+    except Exception:
+        pass
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        try:
+            function(payload)
+        except Exception as e:
+            error = type(e).__name__
+        peak = tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return peak, error
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_baselines():
+    if not os.path.exists(BASELINES):
+        return {}
+    with open(BASELINES) as f:
+        return json.load(f)['results']
+
+def main():
+    parser = argparse.ArgumentParser(description='module_libs decoder microbenchmarks')
+    parser.add_argument('--filter', help='Only run cases whose name (library.function/case) contains this')
+    parser.add_argument('--quick', action='store_true', help='Shorter, noisier runs')
+    parser.add_argument('--update', action='store_true', help=f'Store the results as the new baselines in {os.path.basename(BASELINES)}')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if a case regressed past --threshold')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help=f'Allowed ratio to the baseline for --check (default: {THRESHOLD})')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    target, repeats = (0.05, 5) if args.quick else (0.1, 11)
+    baselines = load_baselines()
+    results = {}
+    regressions = []
+
+    print(f"{'case':<52} {'bytes':>7} {'ns/op':>12} {'peak alloc':>11} {'expected':>12} {'change':>8}")
+    for library, function_name, build_cases in DECODERS:
+        try:
+            function = getattr(importlib.import_module(library), function_name)
+            cases = build_cases()
+        except ImportError as e:
+            print(f"{library + '.' + function_name:<52} skipped: {e}")
+            continue
+        for case, payload in cases.items():
+            name = f"{library}.{function_name}/{case}"
+            if args.filter and args.filter not in name:
+                continue
+            peak, error = measure_allocations(function, payload)
+            ns, reference, relative = time_case(function, payload, target, repeats)
+            results[name] = {'size': len(payload), 'ns_per_op': round(ns, 1), 'reference_ns': round(reference, 1),
+                             'relative': round(relative, 6), 'peak_alloc_bytes': peak, 'raises': error}
+
+            baseline = baselines.get(name)
+            # The baseline timing scaled to how fast the reference workload runs right now
+            # (baselines from before the paired runs only have the two timings)
+            baseline_relative = baseline.get('relative', baseline['ns_per_op'] / baseline['reference_ns']) if baseline else None
+            expected = baseline_relative * reference if baseline else None
+            change = ''
+            if baseline:
+                ratio = relative / baseline_relative
+                change = f"{(ratio - 1) * 100:+.1f}%"
+                if ratio > args.threshold:
+                    regressions.append(f"{name}: {ns:.0f} ns/op vs {expected:.0f} expected from the baseline")
+                # A little slack so tiny allocations don't trip the check
+                if peak > baseline['peak_alloc_bytes'] * args.threshold + 1024:
+                    regressions.append(f"{name}: {peak} bytes peak allocation vs {baseline['peak_alloc_bytes']} baseline")
+            print(f"{name:<52} {len(payload):>7} {ns:>12.0f} {peak:>11} {f'{expected:.0f}' if baseline else '-':>12} {change:>8}"
+                  + (f"  raises {error}" if error else ''), flush=True)
+
+    meta = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.update:
+        # Cases that weren't run this time keep their old baselines
+        with open(BASELINES, 'w') as f:
+            json.dump({'meta': meta, 'results': dict(baselines, **results)}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nBaselines written to {BASELINES}")
+
+    if args.check:
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) past {args.threshold}x:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions past {args.threshold}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+# Parley Benchmark
+# Runs parley.py in front of a local target and measures throughput, latency, CPU and RSS per module configuration
+#
+# Usage: python bench/run_bench.py [--configs direct,passthrough,creds] [--sizes 128,16384] [--mode rr|stream|both]
+#                                  [--connections 16] [--duration 5] [--tls] [--json results.json] [--compare old.json]
+
+import os
+import sys
+import ssl
+import json
+import time
+import shlex
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PARLEY = os.path.join(REPO_DIR, 'parley.py')
+TARGET = os.path.join(BENCH_DIR, 'target_server.py')
+
+# Module configurations: (client modules, server modules). 'direct' skips parley altogether as a baseline.
+CONFIGS = {
+    'direct': None,
+    'passthrough': ([], []),
+    'creds': (['Creds_Client_HTTP_Basic', 'Creds_Client_SMTP_Auth', 'Creds_Client_LDAP_Bind'], []),
+    'display': (['Display_Client_HEX', 'Display_Client_UTF8'], ['Display_Server_HEX']),
+    'modify': (['0-Modify_Client_HTTP_Headers'], []),
+}
+
+REQUEST = b'POST /bench HTTP/1.1\r\nHost: bench\r\nAuthorization: Basic YmVuY2g6YmVuY2g=\r\nContent-Length: %d\r\n\r\n'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, process, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode} before listening on {port}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+def find_module(name):
+    # Look for the module in the enabled and disabled directories of both sides
+    for side in ('modules_client', 'modules_server'):
+        for state in ('enabled', 'disabled'):
+            path = os.path.join(REPO_DIR, side, state, name + '.py')
+            if os.path.exists(path):
+                return side, path
+    raise SystemExit(f"Unknown module: {name}")
+
+def parse_configs(spec):
+    """Config names, or name=Module+Module for an ad hoc set of modules."""
+    configs = {}
+    for entry in spec.split(','):
+        name, _, modules = entry.partition('=')
+        if modules:
+            configs[name] = [find_module(module) for module in modules.split('+')]
+        elif name in CONFIGS:
+            modules = CONFIGS[name]
+            configs[name] = None if modules is None else [find_module(module) for module in modules[0] + modules[1]]
+        else:
+            raise SystemExit(f"Unknown config: {name} (known: {', '.join(CONFIGS)})")
+    return configs
+
+def make_workspace(root, modules):
+    # parley loads modules from its working directory, so each config gets its own
+    workspace = tempfile.mkdtemp(prefix='config-', dir=root)
+    for side in ('modules_client', 'modules_server'):
+        for state in ('enabled', 'disabled'):
+            os.makedirs(os.path.join(workspace, side, state))
+    for side, path in modules:
+        os.symlink(path, os.path.join(workspace, side, 'enabled', os.path.basename(path)))
+    return workspace
+
+def make_certs(root):
+    certfile, keyfile = os.path.join(root, 'cert.pem'), os.path.join(root, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile, '-out', certfile,
+                    '-days', '2', '-subj', '/CN=localhost'], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def process_tree(pid):
+    # The process and its children (worker processes), via /proc
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                            pids.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    pass
+    except OSError:
+        pass
+    return pids
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            return None
+    return total / os.sysconf('SC_CLK_TCK')
+
+def memory_mb(pids, field):
+    # VmRSS (current) or VmHWM (peak) summed over the processes
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith(field + ':'):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return total / 1024
+
+
+async def request_response(port, context, size, deadline, latencies, totals):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=context, server_hostname='localhost' if context else None, limit=1 << 22)
+    request = REQUEST % size + b'x' * size
+    try:
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            writer.write(request)
+            header = await reader.readuntil(b'\r\n\r\n')
+            length = int(header.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            totals['bytes'] += size
+    finally:
+        writer.close()
+
+async def streaming(port, context, size, deadline, totals):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=context, server_hostname='localhost' if context else None)
+    # Doesn't start like an HTTP request, so the target echoes it
+    chunk = b'y' * size
+
+    async def send():
+        while time.perf_counter() < deadline:
+            writer.write(chunk)
+            await writer.drain()
+
+    sender = asyncio.create_task(send())
+    try:
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(reader.read(1 << 20), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            totals['bytes'] += len(data)
+    finally:
+        sender.cancel()
+        writer.close()
+
+async def generate_load(port, context, mode, size, connections, duration):
+    latencies = []
+    totals = {'bytes': 0}
+    deadline = time.perf_counter() + duration
+    if mode == 'rr':
+        tasks = [request_response(port, context, size, deadline, latencies, totals) for _ in range(connections)]
+    else:
+        tasks = [streaming(port, context, size, deadline, totals) for _ in range(connections)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    return latencies, totals['bytes'], errors
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_scenario(args, name, modules, root, tls_files, mode, size):
+    target_port = free_port()
+    target_cmd = [sys.executable, TARGET, str(target_port)]
+    if tls_files:
+        target_cmd += ['--certfile', tls_files[0], '--keyfile', tls_files[1]]
+    target = subprocess.Popen(target_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    parley = None
+    try:
+        wait_for_port(target_port, target)
+        port = target_port
+        if modules is not None:
+            workspace = make_workspace(root, modules)
+            port = free_port()
+            parley_cmd = [sys.executable, PARLEY, '--listen_host', '127.0.0.1', '--listen_port', str(port),
+                          '--target_host', '127.0.0.1', '--target_port', str(target_port), '--engine', args.engine, '--log_only']
+            if tls_files:
+                parley_cmd += ['--use_tls_client', '--certfile', tls_files[0], '--keyfile', tls_files[1], '--use_tls_server', '--no_verify']
+            parley_cmd += shlex.split(args.parley_args)
+            with open(os.path.join(workspace, 'parley.out'), 'w') as output:
+                parley = subprocess.Popen(parley_cmd, cwd=workspace, stdout=output, stderr=subprocess.STDOUT)
+            wait_for_port(port, parley)
+            # The readiness probe above counts as a connection, give it a moment to finish
+            time.sleep(0.2)
+
+        context = None
+        if tls_files:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        pids = process_tree(parley.pid) if parley else [target.pid]
+        # Warm up first, not measured
+        warmup_errors = asyncio.run(generate_load(port, context, mode, size, args.connections, args.warmup))[2]
+        cpu_before = cpu_seconds(pids)
+        started = time.perf_counter()
+        latencies, total_bytes, errors = asyncio.run(generate_load(port, context, mode, size, args.connections, args.duration))
+        elapsed = time.perf_counter() - started
+        cpu_after = cpu_seconds(pids)
+
+        latencies.sort()
+        result = {
+            'config': name,
+            'tls': bool(tls_files),
+            'mode': mode,
+            'size': size,
+            'connections': args.connections,
+            'duration': round(elapsed, 3),
+            'requests': len(latencies) if mode == 'rr' else None,
+            'requests_per_sec': round(len(latencies) / elapsed, 1) if mode == 'rr' else None,
+            'mb_per_sec': round(total_bytes / elapsed / 1e6, 3),
+            'latency_us': {
+                'mean': round(sum(latencies) / len(latencies) * 1e6, 1),
+                'p50': round(percentile(latencies, 0.50) * 1e6, 1),
+                'p99': round(percentile(latencies, 0.99) * 1e6, 1),
+                'p999': round(percentile(latencies, 0.999) * 1e6, 1),
+                'max': round(latencies[-1] * 1e6, 1),
+            } if latencies else None,
+            'cpu_percent': round((cpu_after - cpu_before) / elapsed * 100, 1) if cpu_before is not None and cpu_after is not None else None,
+            'rss_mb': memory_mb(pids, 'VmRSS'),
+            'peak_rss_mb': memory_mb(pids, 'VmHWM'),
+            'errors': [repr(error) for error in warmup_errors + errors][:5],
+        }
+        return result
+    finally:
+        for process in (parley, target):
+            if process:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def scenario_key(result):
+    return (result['config'], result['tls'], result['mode'], result['size'], result['connections'])
+
+def format_result(result):
+    latency = result['latency_us'] or {}
+    rate = f"{result['requests_per_sec']:>10.1f}" if result['requests_per_sec'] is not None else f"{'-':>10}"
+    cells = [f"{result['config']:<14}", f"{'tls' if result['tls'] else 'plain':<6}", f"{result['mode']:<7}", f"{result['size']:>8}",
+             rate, f"{result['mb_per_sec']:>9.2f}"]
+    cells += [f"{latency[key]:>9.1f}" if key in latency else f"{'-':>9}" for key in ('p50', 'p99', 'p999')]
+    cells += [f"{result['cpu_percent']:>6.1f}" if result['cpu_percent'] is not None else f"{'-':>6}",
+              f"{result['peak_rss_mb']:>8.1f}" if result['peak_rss_mb'] is not None else f"{'-':>8}"]
+    return ' '.join(cells)
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {scenario_key(result): result for result in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get(scenario_key(result))
+        if not old:
+            continue
+        throughput = (result['mb_per_sec'] / old['mb_per_sec'] - 1) * 100 if old['mb_per_sec'] else 0
+        line = f"  {result['config']:<14} {'tls' if result['tls'] else 'plain':<6} {result['mode']:<7} {result['size']:>8}  throughput {throughput:+6.1f}%"
+        if result['latency_us'] and old['latency_us']:
+            line += f"  p99 {(result['latency_us']['p99'] / old['latency_us']['p99'] - 1) * 100:+6.1f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Parley throughput/latency benchmark')
+    parser.add_argument('--configs', default='direct,passthrough,creds', help=f"Comma separated module configs: {', '.join(CONFIGS)} or name=Module+Module (default: direct,passthrough,creds)")
+    parser.add_argument('--sizes', default='128,16384', help='Comma separated message sizes in bytes (default: 128,16384)')
+    parser.add_argument('--mode', choices=['rr', 'stream', 'both'], default='rr', help='Request/response, streaming, or both (default: rr)')
+    parser.add_argument('--connections', type=int, default=16, help='Concurrent connections (default: 16)')
+    parser.add_argument('--duration', type=float, default=5.0, help='Measured seconds per scenario (default: 5)')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Unmeasured seconds before each scenario (default: 1)')
+    parser.add_argument('--tls', action='store_true', help='Also run every scenario with TLS on both sides of the proxy')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='parley.py connection engine (default: threads)')
+    parser.add_argument('--parley_args', default='', help='Extra parley.py arguments, e.g. "--workers 2"')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in an earlier --json file')
+    args = parser.parse_args()
+
+    configs = parse_configs(args.configs)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    modes = ['rr', 'stream'] if args.mode == 'both' else [args.mode]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='parley-bench-') as root:
+        tls_options = [None]
+        if args.tls:
+            tls_options.append(make_certs(root))
+
+        print(f"{'config':<14} {'tls':<6} {'mode':<7} {'size':>8} {'req/s':>10} {'MB/s':>9} {'p50 us':>9} {'p99 us':>9} {'p999 us':>9} {'cpu%':>6} {'peak MB':>8}")
+        for name, modules in configs.items():
+            for tls_files in tls_options:
+                for mode in modes:
+                    for size in sizes:
+                        result = run_scenario(args, name, modules, root, tls_files, mode, size)
+                        results.append(result)
+                        print(format_result(result), flush=True)
+                        for error in result['errors']:
+                            print(f"    error: {error}")
+
+    if args.json:
+        meta = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args)}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == '__main__':
+    main()
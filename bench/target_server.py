@@ -0,0 +1,80 @@
+# Benchmark Target
+# Local echo / HTTP-like server for the benchmark suite
+#
+# Connections starting with an HTTP request get one HTTP response per request, echoing the request body.
+# Anything else is echoed back byte for byte.
+#
+# Usage: python target_server.py PORT [--certfile cert.pem --keyfile key.pem]
+
+import argparse
+import asyncio
+import ssl
+
+HTTP_METHODS = (b'GET ', b'POST', b'PUT ')
+
+
+class TargetProtocol(asyncio.Protocol):
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.buffer = bytearray()
+        self.http = None  # Decided by the first bytes of the connection
+
+    def data_received(self, data):
+        if self.http is None:
+            self.buffer += data
+            if len(self.buffer) < 4:
+                return
+            self.http = bytes(self.buffer[:4]) in HTTP_METHODS
+            data = bytes(self.buffer)
+            self.buffer = bytearray()
+
+        if not self.http:
+            self.transport.write(data)
+            return
+
+        self.buffer += data
+        while True:
+            header_end = self.buffer.find(b'\r\n\r\n')
+            if header_end < 0:
+                return
+            length = 0
+            for line in bytes(self.buffer[:header_end]).split(b'\r\n')[1:]:
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            end = header_end + 4 + length
+            if len(self.buffer) < end:
+                return
+            body = bytes(self.buffer[header_end + 4:end])
+            del self.buffer[:end]
+            self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+
+    def pause_writing(self):
+        # The client is not reading fast enough, stop reading from it too
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+
+async def main(port, certfile=None, keyfile=None):
+    context = None
+    if certfile:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(TargetProtocol, '127.0.0.1', port, ssl=context, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Echo / HTTP-like benchmark target')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.port, args.certfile, args.keyfile))
+    except KeyboardInterrupt:
+        pass
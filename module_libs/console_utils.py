@@ -0,0 +1,118 @@
+# Console Output
+# Module and connection output written to the terminal by one thread, in batches and optionally rate limited
+
+import os
+import sys
+import atexit
+import queue
+import threading
+import time
+
+# Most messages joined into a single write to the terminal
+MAX_BATCH = 256
+
+
+class ConsoleWriter:
+    """
+    Writes console messages from a background thread.
+    Callers only queue the message, so connection threads never contend for stdout.
+    """
+
+    def __init__(self, rate=0, log_only=False):
+        self.rate = rate  # messages per second, 0 for no limit
+        self.log_only = log_only
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.pid = None
+        # Only touched by the writer thread
+        self.window = 0
+        self.shown = 0
+        self.suppressed = 0
+
+    def start(self):
+        # Started on first use, and again in a forked child where the parent's thread does not exist
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name='console-writer', daemon=True).start()
+
+    def write(self, message):
+        if self.log_only:
+            return
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put(message)
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far has been written."""
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            try:
+                # Wake up once a second while messages are being suppressed, to report them
+                batch = [self.queue.get(timeout=1.0 if self.suppressed else None)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            output = []
+            flushed = []
+            for message in batch:
+                if isinstance(message, threading.Event):
+                    flushed.append(message)
+                elif self.admit(output):
+                    output.append(message + '\n')
+            # A flush (e.g. at exit) reports suppressed messages without waiting for the window to end
+            self.admit(output, count=False, report=bool(flushed))
+
+            if output:
+                try:
+                    sys.stdout.write(''.join(output))
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+            for done in flushed:
+                done.set()
+
+    def admit(self, output, count=True, report=False):
+        # Rate limit per one-second window, a summary line replaces what was dropped
+        now = time.monotonic()
+        if now - self.window >= 1.0 or report:
+            if self.suppressed:
+                output.append(f"[!] {self.suppressed} console messages suppressed (--console_rate {self.rate})\n")
+            self.window = now
+            self.shown = self.suppressed = 0
+        if not count:
+            return False
+        if self.rate and self.shown >= self.rate:
+            self.suppressed += 1
+            return False
+        self.shown += 1
+        return True
+
+
+console_writer = ConsoleWriter()
+atexit.register(console_writer.flush)
+
+
+def configure_console(rate=0, log_only=False):
+    # rate: messages per second shown on the terminal (0 = all), log_only: show nothing at all
+    console_writer.rate = rate
+    console_writer.log_only = log_only
+
+def console_print(message):
+    # Queue a message for the terminal, the writer thread does the actual write
+    console_writer.write(str(message))
+
+def flush_console():
+    # Block until everything queued so far is on the terminal, e.g. before prompting the user
+    console_writer.flush()
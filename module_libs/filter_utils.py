@@ -0,0 +1,118 @@
+# Module Filters
+# Compiles a module's module_filter settings into a predicate the engine checks before calling module_function
+
+import ipaddress
+
+from stats_utils import counters
+
+FILTER_KEYS = ('source', 'dest', 'source_port', 'dest_port', 'message_num', 'size', 'once')
+
+# Resolved addresses kept per filter before the cache is started over
+MAX_CACHED_ADDRESSES = 4096
+
+
+def parse_ranges(value, what):
+    """5, '1-3', '8000-', '-4096' or a list of those -> [(low, high)], high None for open ended."""
+    ranges = []
+    for item in value if isinstance(value, (list, tuple, set)) else [value]:
+        if isinstance(item, bool):
+            raise ValueError(f"{what}: {item!r} is not a number or range")
+        if isinstance(item, int):
+            ranges.append((item, item))
+            continue
+        if isinstance(item, str):
+            low, dash, high = item.strip().partition('-')
+            try:
+                if not dash:
+                    ranges.append((int(low), int(low)))
+                else:
+                    ranges.append((int(low) if low.strip() else 0, int(high) if high.strip() else None))
+                continue
+            except ValueError:
+                pass
+        raise ValueError(f"{what}: {item!r} is not a number or range such as 5, '1-3' or '8000-'")
+    return ranges
+
+def parse_networks(value, what):
+    """'10.0.0.0/8', '192.168.1.5', '::1' or a list of those -> [ip_network]."""
+    networks = []
+    for item in value if isinstance(value, (list, tuple, set)) else [value]:
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except (TypeError, ValueError):
+            raise ValueError(f"{what}: {item!r} is not an IP address or CIDR network") from None
+    return networks
+
+def in_ranges(number, ranges):
+    for low, high in ranges:
+        if number >= low and (high is None or number <= high):
+            return True
+    return False
+
+
+class ModuleFilter:
+    """
+    A compiled module_filter. Every key given must match:
+    source / dest: IP addresses or CIDR networks; source_port / dest_port, message_num, size: numbers or ranges;
+    once: the module runs for at most one message per connection direction (see applies()).
+    """
+
+    def __init__(self, spec, label):
+        if not isinstance(spec, dict):
+            raise ValueError(f"{label}: module_filter must be a dict")
+        unknown = set(spec) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"{label}: unknown module_filter keys {', '.join(sorted(unknown))} (known: {', '.join(FILTER_KEYS)})")
+        self.source = parse_networks(spec['source'], f"{label} source") if 'source' in spec else None
+        self.dest = parse_networks(spec['dest'], f"{label} dest") if 'dest' in spec else None
+        self.source_port = parse_ranges(spec['source_port'], f"{label} source_port") if 'source_port' in spec else None
+        self.dest_port = parse_ranges(spec['dest_port'], f"{label} dest_port") if 'dest_port' in spec else None
+        self.message_num = parse_ranges(spec['message_num'], f"{label} message_num") if 'message_num' in spec else None
+        self.size = parse_ranges(spec['size'], f"{label} size") if 'size' in spec else None
+        self.once = bool(spec.get('once'))
+        self.skip_counter = f"filter_skips:{label}"
+        self.addresses = {}  # IP string -> whether it is in source/dest, per check
+
+    def in_networks(self, ip, networks, key):
+        cached = self.addresses.get((key, ip))
+        if cached is None:
+            try:
+                address = ipaddress.ip_address(ip.split('%')[0])
+            except ValueError:
+                address = None
+            if address is not None and address.version == 6 and address.ipv4_mapped:
+                # Dual stack listeners see IPv4 clients as ::ffff:a.b.c.d
+                address = address.ipv4_mapped
+            cached = address is not None and any(address in network for network in networks)
+            if len(self.addresses) >= MAX_CACHED_ADDRESSES:
+                self.addresses.clear()
+            self.addresses[(key, ip)] = cached
+        return cached
+
+    def check(self, message_num, source_ip, source_port, dest_ip, dest_port, size):
+        return ((self.message_num is None or in_ranges(message_num, self.message_num)) and
+                (self.size is None or in_ranges(size, self.size)) and
+                (self.source_port is None or in_ranges(source_port, self.source_port)) and
+                (self.dest_port is None or in_ranges(dest_port, self.dest_port)) and
+                (self.source is None or self.in_networks(source_ip, self.source, 'source')) and
+                (self.dest is None or self.in_networks(dest_ip, self.dest, 'dest')))
+
+    def applies(self, module_name, done, message_num, source_ip, source_port, dest_ip, dest_port, size):
+        """
+        Whether the module should see this message. done is the set of once-modules that have already run on this
+        connection direction, or None when there is no connection to track it for.
+        """
+        if (self.once and done is not None and module_name in done) or not self.check(message_num, source_ip, source_port, dest_ip, dest_port, size):
+            counters.incr(self.skip_counter)
+            return False
+        return True
+
+
+def compile_filters(loaded_modules, side):
+    """{module name: ModuleFilter} for the modules that declare a module_filter. Raises ValueError for a bad one."""
+    filters = {}
+    for module_name, module in loaded_modules.items():
+        spec = getattr(module, 'module_filter', None)
+        if spec:
+            filters[module_name] = ModuleFilter(spec, f"{side}/{module_name}")
+    return filters
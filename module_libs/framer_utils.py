@@ -0,0 +1,359 @@
+# Message Framers
+# Reassemble exact protocol message boundaries from a TCP stream, so modules see one whole message at a time
+
+import sys
+import collections
+
+from stats_utils import counters
+
+# frame_size() result for a message that runs until the connection closes
+UNTIL_CLOSE = sys.maxsize
+
+
+class Framer:
+    """
+    Incremental framer for one direction of a connection.
+    feed() takes the bytes as they arrive and returns the complete messages found so far.
+    At most max_size bytes are held back: a longer message is handed on in pieces as it arrives.
+    """
+
+    # Set once the stream is no longer framed (e.g. after an HTTP upgrade), from then on data is handed on as it comes
+    unframed = False
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.passthrough = 0  # Bytes of an oversized message still to be handed on unframed
+        self.scanned = 0  # How far frame_size() has already searched the buffer
+
+    def frame_size(self, buffer):
+        """Total size of the first message in buffer, or None if more data is needed to tell."""
+        raise NotImplementedError
+
+    def feed(self, data):
+        if self.unframed and not self.buffer:
+            return [bytearray(data)] if data else []
+        messages = []
+        if self.passthrough:
+            piece = data[:self.passthrough]
+            self.passthrough -= len(piece)
+            self.consumed(len(piece))
+            messages.append(bytearray(piece))
+            data = data[len(piece):]
+        self.buffer += data
+
+        while self.buffer and not self.passthrough:
+            if self.unframed:
+                messages.append(self.take(len(self.buffer), complete=False))
+                break
+            size = self.frame_size(self.buffer)
+            if size is None:
+                if len(self.buffer) > self.max_size:
+                    # No boundary within max_size bytes, don't hold the data back any longer
+                    counters.incr('framer_overflows')
+                    messages.append(self.take(len(self.buffer), complete=False))
+                break
+            if size > self.max_size and len(self.buffer) < size:
+                # Too big to hold back whole, hand on what is here and the rest as it arrives
+                counters.incr('framer_overflows')
+                self.passthrough = size - len(self.buffer) if size != UNTIL_CLOSE else UNTIL_CLOSE
+                messages.append(self.take(len(self.buffer)))
+                break
+            if len(self.buffer) < size:
+                break
+            messages.append(self.take(size))
+        return messages
+
+    def flush(self):
+        """Return whatever is left over as a final message, e.g. when the connection closes."""
+        return [self.take(len(self.buffer))] if self.buffer else []
+
+    def take(self, size, complete=True):
+        message = self.buffer[:size]
+        del self.buffer[:size]
+        self.scanned = 0
+        self.consumed(size)
+        if complete:
+            self.reset()
+        return message
+
+    def consumed(self, size):
+        # Called with the number of bytes handed on, for framers that track stream positions
+        pass
+
+    def reset(self):
+        # Per-message parse state is cleared once a whole message has been taken
+        pass
+
+
+class LengthFramer(Framer):
+    # N-byte length prefix, the length counting the bytes after the header unless inclusive
+
+    def __init__(self, max_size, header_size=2, byteorder='big', inclusive=False):
+        super().__init__(max_size)
+        self.header_size = header_size
+        self.byteorder = byteorder
+        self.inclusive = inclusive
+
+    def frame_size(self, buffer):
+        if len(buffer) < self.header_size:
+            return None
+        length = int.from_bytes(buffer[:self.header_size], self.byteorder)
+        if self.inclusive:
+            # A length shorter than its own header is garbage, pass the buffer on as it is
+            return length if length >= self.header_size else len(buffer)
+        return self.header_size + length
+
+
+class DelimiterFramer(Framer):
+    # Messages end with (and include) a delimiter such as CRLF
+
+    def __init__(self, max_size, delimiter=b'\r\n'):
+        super().__init__(max_size)
+        self.delimiter = delimiter
+
+    def frame_size(self, buffer):
+        # Only search the new bytes, plus enough overlap for a delimiter split across reads
+        end = buffer.find(self.delimiter, max(self.scanned - len(self.delimiter) + 1, 0))
+        if end < 0:
+            self.scanned = len(buffer)
+            return None
+        return end + len(self.delimiter)
+
+
+class FixFramer(Framer):
+    # FIX: 8=BeginString|9=BodyLength|<body>10=CheckSum|, the body length counting from after the 9= field
+
+    def frame_size(self, buffer):
+        if not buffer.startswith(b'8=FIX'):
+            if len(buffer) < 5 and b'8=FIX'.startswith(bytes(buffer)):
+                return None
+            # Anything before the next BeginString is passed on by itself
+            return self.resync(buffer)
+        begin_end = buffer.find(b'\x01')
+        if begin_end < 0:
+            return None
+        length_end = buffer.find(b'\x01', begin_end + 1)
+        if length_end < 0:
+            return None
+        if not buffer.startswith(b'9=', begin_end + 1):
+            return self.resync(buffer)
+        try:
+            body_end = length_end + 1 + int(buffer[begin_end + 3:length_end])
+        except ValueError:
+            return self.resync(buffer)
+        # 10=NNN plus its SOH
+        if len(buffer) < body_end + 7:
+            return body_end + 7
+        if not buffer.startswith(b'10=', body_end):
+            return self.resync(buffer)
+        checksum_end = buffer.find(b'\x01', body_end)
+        return checksum_end + 1 if checksum_end >= 0 else None
+
+    def resync(self, buffer):
+        # Not FIX or a broken header: pass on everything up to the next BeginString, or all of it if there is none,
+        # so a session that isn't FIX isn't held back
+        start = buffer.find(b'8=FIX', 1)
+        return start if start > 0 else len(buffer)
+
+
+class BerFramer(Framer):
+    # BER TLV (LDAP, SNMP, ...): tag, definite length, contents
+
+    def frame_size(self, buffer):
+        tag = buffer[0]
+        if (tag & 0xc0 == 0 and tag not in (0x30, 0x31)) or (tag & 0xc0 and not tag & 0x20):
+            # A PDU is a constructed SEQUENCE / SET or application / context / private type; this isn't BER,
+            # pass what is buffered on as it is rather than holding it back
+            return len(buffer)
+        if len(buffer) < 2:
+            return None
+        position = 1
+        if buffer[0] & 0x1f == 0x1f:
+            # High tag number form, continued while the top bit is set
+            while position < len(buffer) and buffer[position] & 0x80:
+                position += 1
+            position += 1
+        if position >= len(buffer):
+            return None
+        first = buffer[position]
+        if first < 0x80:
+            return position + 1 + first
+        count = first & 0x7f
+        if count == 0 or count > 8:
+            # Indefinite or absurd lengths are not framed, pass the buffer on as it is
+            return len(buffer)
+        if len(buffer) < position + 1 + count:
+            return None
+        return position + 1 + count + int.from_bytes(buffer[position + 1:position + 1 + count], 'big')
+
+
+class HttpExchange:
+    # Shared by the request and response framers of one connection: a response's framing depends on its request
+
+    def __init__(self):
+        self.methods = collections.deque()  # Methods of the requests still waiting for their response, in order
+        self.upgraded = False  # 101 Switching Protocols or a CONNECT tunnel, the rest of the connection isn't HTTP
+        self.linked = False  # Whether a response framer takes the methods, otherwise they aren't kept
+
+
+class HttpFramer(Framer):
+    # HTTP/1.x: headers, then a Content-Length or chunked body; responses without either run until close.
+    # With observe set the framer only follows the requests for their methods and hands the data on as it came.
+
+    def __init__(self, max_size, exchange=None, observe=False):
+        super().__init__(max_size)
+        self.offset = 0  # Stream position of buffer[0], parse positions are kept as stream positions
+        self.exchange = exchange or HttpExchange()
+        self.observe = observe
+        self.continued = None  # Body framing of an Expect: 100-continue request whose headers have gone on by themselves
+        self.reset()
+
+    @property
+    def unframed(self):
+        return self.exchange.upgraded
+
+    def feed(self, data):
+        if not self.observe:
+            return super().feed(data)
+        if not self.unframed:
+            super().feed(data)
+        return [bytearray(data)] if data else []
+
+    def flush(self):
+        return [] if self.observe else super().flush()
+
+    def consumed(self, size):
+        self.offset += size
+
+    def reset(self):
+        self.header_end = None
+        self.body = None  # ('length', end), ('chunked', next chunk size line) or ('close', None)
+
+    def frame_size(self, buffer):
+        if self.header_end is None and self.continued:
+            # The body the client held back until the server's 100 Continue, framed as a message of its own
+            kind, size = self.continued
+            self.continued = None
+            self.header_end = self.offset
+            self.body = (kind, self.offset + size)
+        if self.header_end is None:
+            end = buffer.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+            if end < 0:
+                self.scanned = len(buffer)
+                return None
+            self.header_end = self.offset + end + 4
+            self.body = self.body_framing(bytes(buffer[:end]))
+
+        kind, position = self.body
+        if kind == 'length':
+            return position - self.offset
+        if kind == 'close':
+            return UNTIL_CLOSE
+
+        # Chunked: walk the chunks from where the last call stopped
+        while True:
+            line_start = position - self.offset
+            if line_start < 0:
+                # The size line went out with an oversized piece, framing is lost for this message
+                return len(buffer)
+            line_end = buffer.find(b'\r\n', line_start)
+            if line_end < 0:
+                return None
+            try:
+                size = int(buffer[line_start:line_end].split(b';')[0], 16)
+            except ValueError:
+                return len(buffer)
+            if size == 0:
+                # Optional trailers, then the blank line
+                if buffer.startswith(b'\r\n', line_end + 2):
+                    return line_end + 4
+                trailers_end = buffer.find(b'\r\n\r\n', line_end + 2)
+                return trailers_end + 4 if trailers_end >= 0 else None
+            position = self.offset + line_end + 2 + size + 2
+            self.body = ('chunked', position)
+
+    def body_framing(self, headers):
+        lines = headers.split(b'\r\n')
+        response = lines[0].startswith(b'HTTP/')
+        if response:
+            status = lines[0].split(b' ', 2)[1:2]
+            status = status[0] if status else b''
+            if status.startswith(b'1') and status != b'101':
+                # Interim response, the final one for the same request follows
+                return ('length', self.header_end)
+            method = self.exchange.methods.popleft() if self.exchange.methods else None
+            if status == b'101' or (method == b'CONNECT' and status.startswith(b'2')):
+                # Whatever follows belongs to the new protocol
+                self.exchange.upgraded = True
+                return ('length', self.header_end)
+            if method == b'HEAD' or status in (b'204', b'304'):
+                # No body, whatever Content-Length says
+                return ('length', self.header_end)
+        elif self.exchange.linked:
+            self.exchange.methods.append(lines[0].split(b' ', 1)[0].upper())
+        fields = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            fields[name.strip().lower()] = value.strip().lower()
+        body = None
+        if b'chunked' in fields.get(b'transfer-encoding', b''):
+            body = ('chunked', 0)
+        elif b'content-length' in fields:
+            try:
+                body = ('length', int(fields[b'content-length']))
+            except ValueError:
+                pass
+        if body is None:
+            return ('close', None) if response else ('length', self.header_end)
+        if not response and b'100-continue' in fields.get(b'expect', b'') and body != ('length', 0):
+            # The client only sends the body once the server has seen the headers, so they can't wait for it
+            self.continued = body
+            return ('length', self.header_end)
+        return (body[0], self.header_end + body[1])
+
+
+def link_framers(client_framer, server_framer, max_size):
+    """
+    Connect the two framers of one connection where one side's framing depends on the other.
+    An http server framer learns the request methods (HEAD responses have no body) from the client side, which is
+    followed by an observing framer if it isn't framed itself. Returns (client framer, server framer).
+    """
+    if isinstance(server_framer, HttpFramer):
+        if isinstance(client_framer, HttpFramer):
+            server_framer.exchange = client_framer.exchange
+        elif client_framer is None:
+            client_framer = HttpFramer(max_size, server_framer.exchange, observe=True)
+        server_framer.exchange.linked = isinstance(client_framer, HttpFramer)
+    return client_framer, server_framer
+
+
+def make_framer(spec, max_size):
+    """
+    Build a framer from a --framer_client/--framer_server spec:
+    none, length:N[:little][:inclusive], delimiter[:HEX], fix, ber or http.
+    Raises ValueError for an unknown spec.
+    """
+    name, _, rest = (spec or 'none').partition(':')
+    args = rest.split(':') if rest else []
+    if name == 'none':
+        return None
+    if name == 'length':
+        if not args or not args[0].isdigit() or int(args[0]) not in (1, 2, 4, 8):
+            raise ValueError("length framer needs a header size of 1, 2, 4 or 8 bytes, e.g. length:2")
+        flags = set(args[1:])
+        if flags - {'little', 'inclusive'}:
+            raise ValueError(f"unknown length framer flags: {', '.join(sorted(flags - {'little', 'inclusive'}))}")
+        return LengthFramer(max_size, int(args[0]), 'little' if 'little' in flags else 'big', 'inclusive' in flags)
+    if name == 'delimiter':
+        try:
+            delimiter = bytes.fromhex(args[0]) if args else b'\r\n'
+        except ValueError:
+            delimiter = None
+        if not delimiter:
+            raise ValueError("delimiter framer needs a non-empty hex delimiter, e.g. delimiter:0a")
+        return DelimiterFramer(max_size, delimiter)
+    framers = {'fix': FixFramer, 'ber': BerFramer, 'http': HttpFramer}
+    if name not in framers or args:
+        raise ValueError(f"unknown framer: {spec}")
+    return framers[name](max_size)
@@ -3,7 +3,11 @@
 import iso8583
 from iso8583.specs import default_ascii as spec
 
+from message_utils import MessageContext
+
 def decode_iso8583(raw_data):
+    if isinstance(raw_data, MessageContext):
+        raw_data = raw_data.as_bytes()
     try:
         # Since decode() might return a tuple, we'll unpack it if it does
         decoded, _ = iso8583.decode(raw_data, spec=spec)  # Assuming the second item in the tuple isn't needed
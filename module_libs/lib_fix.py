@@ -1,6 +1,8 @@
 # FIX Protocol (Financial Information eXchange) Parser
 # Common FIX tags and message types for decoding
 
+from message_utils import MessageContext
+
 # FIX Message Types (Tag 35)
 MESSAGE_TYPES = {
     '0': 'Heartbeat',
@@ -618,18 +620,21 @@ EXEC_TYPE = {
 
 def decode_fix(data):
     """
-    Decode a FIX message from bytes.
+    Decode a FIX message from bytes or a MessageContext.
     Returns a list of (tag_name, tag_num, value, decoded_value) tuples.
     """
-    if isinstance(data, bytearray):
-        data = bytes(data)
-    
+    if isinstance(data, MessageContext):
+        message_str = data.text('ascii')
+    else:
+        if isinstance(data, bytearray):
+            data = bytes(data)
+
+        try:
+            message_str = data.decode('ascii', errors='replace')
+        except:
+            message_str = data.decode('latin-1', errors='replace')
+
     # FIX uses SOH (0x01) as delimiter
-    try:
-        message_str = data.decode('ascii', errors='replace')
-    except:
-        message_str = data.decode('latin-1', errors='replace')
-    
     # Replace SOH with pipe for splitting
     message_str = message_str.replace('\x01', '|')
     
@@ -4,13 +4,17 @@
 import base64
 import re
 
+from message_utils import MessageContext
+
 
 def extract_basic_auth(data):
     """
     Extract Basic auth credentials from HTTP request data.
     Returns list of (username, password) tuples found.
     """
-    if isinstance(data, (bytes, bytearray)):
+    if isinstance(data, MessageContext):
+        data = data.text()
+    elif isinstance(data, (bytes, bytearray)):
         try:
             data = data.decode('utf-8', errors='replace')
         except:
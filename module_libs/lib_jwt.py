@@ -6,6 +6,8 @@ import json
 import re
 from datetime import datetime, timezone
 
+from message_utils import MessageContext
+
 def base64url_decode(data):
     """Decode base64url (URL-safe base64 without padding)."""
     # Add padding if needed
@@ -22,7 +24,9 @@ def extract_bearer_tokens(data):
     Extract Bearer tokens from HTTP request/response data.
     Returns a list of tokens found.
     """
-    if isinstance(data, (bytes, bytearray)):
+    if isinstance(data, MessageContext):
+        data = data.text()
+    elif isinstance(data, (bytes, bytearray)):
         try:
             data = data.decode('utf-8', errors='replace')
         except:
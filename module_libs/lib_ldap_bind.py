@@ -2,6 +2,8 @@
 # Extracts credentials from LDAP BindRequest messages
 # LDAP uses ASN.1 BER encoding
 
+from message_utils import MessageContext
+
 def decode_ber_length(data, offset):
     """Decode BER length field, return (length, bytes_consumed)."""
     if offset >= len(data):
@@ -43,7 +45,7 @@ def decode_ber_string(data, offset):
         return None, 0
     
     try:
-        value = data[start:end].decode('utf-8', errors='replace')
+        value = str(data[start:end], 'utf-8', errors='replace')
     except:
         value = data[start:end].hex()
     
@@ -67,10 +69,11 @@ def extract_ldap_simple_bind(data):
         }
     }
     
+    Takes bytes, a bytearray, a memoryview or a MessageContext, read in place without a copy.
     Returns list of (dn, password) tuples.
     """
-    if isinstance(data, bytearray):
-        data = bytes(data)
+    if isinstance(data, MessageContext):
+        data = data.data
     
     credentials = []
     
@@ -122,7 +125,7 @@ def extract_ldap_simple_bind(data):
                     
                     if pwd_end <= len(data):
                         try:
-                            password = data[pwd_start:pwd_end].decode('utf-8', errors='replace')
+                            password = str(data[pwd_start:pwd_end], 'utf-8', errors='replace')
                         except:
                             password = data[pwd_start:pwd_end].hex()
                         
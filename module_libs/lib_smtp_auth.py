@@ -4,6 +4,8 @@
 import base64
 import re
 
+from message_utils import MessageContext
+
 
 def decode_auth_plain(b64_data):
     """
@@ -38,7 +40,9 @@ def extract_smtp_auth(data):
     Handles AUTH PLAIN and AUTH LOGIN mechanisms.
     Returns list of credential dicts.
     """
-    if isinstance(data, (bytes, bytearray)):
+    if isinstance(data, MessageContext):
+        data = data.text()
+    elif isinstance(data, (bytes, bytearray)):
         try:
             data = data.decode('utf-8', errors='replace')
         except:
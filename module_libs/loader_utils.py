@@ -0,0 +1,105 @@
+# Module Loading
+# Reads a module's settings without running it, so the import can wait until the first message reaches the module
+
+import ast
+import importlib.util
+import threading
+import time
+
+
+def read_manifest(path):
+    """
+    Read a module's top level module_* settings and hook functions from its source, without executing it.
+    Returns {'values': {name: value}, 'hooks': [function names]}, or None if the settings can't be read
+    statically (a setting that isn't a plain literal, or no module_description), in which case the module
+    has to be imported to find out.
+    """
+    with open(path, 'rb') as f:
+        try:
+            tree = ast.parse(f.read(), path)
+        except SyntaxError:
+            return None
+
+    values = {}
+    hooks = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name.startswith('module_'):
+            hooks.append(node.name)
+            continue
+        if isinstance(node, ast.Assign):
+            targets, value = node.targets, node.value
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets, value = [node.target], node.value
+        else:
+            continue
+        for target in targets:
+            if isinstance(target, ast.Name) and target.id.startswith('module_'):
+                try:
+                    values[target.id] = ast.literal_eval(value)
+                except ValueError:
+                    return None
+
+    if 'module_function' not in hooks or 'module_function' in values or not isinstance(values.get('module_description'), str):
+        return None
+    return {'values': values, 'hooks': hooks}
+
+
+def import_module_file(module_name, path):
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LazyModule:
+    """
+    Stands in for a module until its module_function is first called.
+    Settings from the manifest are answered without importing; anything else imports the module.
+    on_import(lazy_module) is called once the import is done, e.g. to report how long it took.
+    """
+
+    def __init__(self, module_name, path, manifest, on_import=None):
+        self.__name__ = self.module_name = module_name
+        self.path = path
+        self.manifest = manifest
+        self.on_import = on_import
+        self.module = None
+        self.import_ms = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.module is None:
+            with self.lock:
+                if self.error:
+                    # Don't retry a failed import on every message
+                    raise ImportError(f"module {self.module_name} failed to import: {self.error}")
+                if self.module is None:
+                    started = time.perf_counter()
+                    try:
+                        module = import_module_file(self.module_name, self.path)
+                    except Exception as e:
+                        self.error = f"{type(e).__name__}: {e}"
+                        raise
+                    self.import_ms = (time.perf_counter() - started) * 1000
+                    self.module = module
+                    if self.on_import:
+                        self.on_import(self)
+        return self.module
+
+    def module_function(self, message_num, source_ip, source_port, dest_ip, dest_port, message_data, *context):
+        function = self.load().module_function
+        if 'module_function' not in self.__dict__:
+            # Later calls go straight to the module, unless something (e.g. profiling) has wrapped this one
+            self.module_function = function
+        return function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, *context)
+
+    def __getattr__(self, name):
+        # Only called for attributes not set on the instance or the class
+        manifest = self.__dict__.get('manifest')
+        if manifest is not None and name.startswith('module_'):
+            if name in manifest['values']:
+                return manifest['values'][name]
+            if name not in manifest['hooks']:
+                raise AttributeError(name)
+        return getattr(self.load(), name)
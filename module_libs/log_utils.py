@@ -1,24 +1,153 @@
 import os
+import atexit
+import collections
 import datetime
+import queue
+import threading
+import time
+
+# Per-connection log files are kept open between writes, least recently used first out
+MAX_OPEN_FILES = 64
+# Buffered lines are written out once this many characters are waiting, or after FLUSH_INTERVAL seconds
+FLUSH_SIZE = 65536
+FLUSH_INTERVAL = 1.0
+
+
+class LogWriter:
+    """
+    Writes log lines from a background thread.
+    Callers only queue the line, so connection threads never wait on the disk.
+    """
+
+    def __init__(self, base_dir='logs', max_open=MAX_OPEN_FILES, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.base_dir = base_dir
+        self.max_open = max_open
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.pid = None
+        # Only touched by the writer thread
+        self.files = collections.OrderedDict()  # path -> open file, oldest first
+        self.pending = {}  # file name -> lines not yet written
+        self.pending_size = 0
+        self.log_dir = None
+        self.day = None
+
+    def start(self):
+        # Started on first use, and again in a forked child where the parent's thread does not exist
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name='log-writer', daemon=True).start()
+
+    def write(self, file_name, message):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put((file_name, message))
+
+    def close(self, file_name):
+        """Write out and close one log file, e.g. when its connection ends."""
+        if self.pid == os.getpid():
+            self.queue.put((file_name, None))
+
+    def flush(self, timeout=5.0):
+        """Write out everything queued so far and wait until it is on disk."""
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait(timeout)
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                file_name, message = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                file_name = message = None
+
+            if isinstance(message, str):
+                self.pending.setdefault(file_name, []).append(message + '\n')
+                self.pending_size += len(message) + 1
+            elif file_name is not None:
+                self.write_pending(file_name)
+                self.close_file(file_name)
+            elif message is not None:
+                self.write_all()
+                message.set()
+
+            if self.pending_size >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                self.write_all()
+                last_flush = time.monotonic()
+
+    def write_all(self):
+        for file_name in list(self.pending):
+            self.write_pending(file_name)
+        for f in self.files.values():
+            try:
+                f.flush()
+            except OSError as e:
+                print(f"Error writing log file {f.name}: {e}")
+
+    def write_pending(self, file_name):
+        lines = self.pending.pop(file_name, None)
+        if not lines:
+            return
+        self.pending_size -= sum(len(line) for line in lines)
+        try:
+            self.open_file(file_name).write(''.join(lines))
+        except OSError as e:
+            print(f"Error writing log file {file_name}: {e}")
+
+    def open_file(self, file_name):
+        today = datetime.date.today()
+        if today != self.day:
+            # Date rollover, later lines go to the new day's directory
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+            self.day = today
+            self.log_dir = os.path.join(self.base_dir, today.strftime('%m-%d-%Y'))
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        path = os.path.join(self.log_dir, file_name)
+        f = self.files.get(path)
+        if f is not None:
+            self.files.move_to_end(path)
+            return f
+        if len(self.files) >= self.max_open:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        f = self.files[path] = open(path, 'a')
+        return f
+
+    def close_file(self, file_name):
+        if self.log_dir is None:
+            return
+        f = self.files.pop(os.path.join(self.log_dir, file_name), None)
+        if f is not None:
+            f.close()
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+
+
+def log_file_name(source_ip, source_port, dest_ip, dest_port):
+    return f"{source_ip}-{source_port}-{dest_ip}-{dest_port}.log"
 
 def write_to_log(source_ip, source_port, dest_ip, dest_port, message):
-    # Ensure the logs directory exists
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-
-    # Create log directory for today if it doesn't exist
-    today = datetime.date.today()
-    log_dir = os.path.join('logs', today.strftime('%m-%d-%Y'))
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    # Construct the log file name
-    log_file_name = f"{source_ip}-{source_port}-{dest_ip}-{dest_port}.log"
-    log_file_path = os.path.join(log_dir, log_file_name)
-
-    # Write the message atomically
-    with open(log_file_path, 'a') as f:
-        f.write(message + '\n')
+    # Queue the message for logs/<date>/<source>-<dest>.log, the writer thread does the file I/O
+    log_writer.write(log_file_name(source_ip, source_port, dest_ip, dest_port), message)
+
+def close_log(source_ip, source_port, dest_ip, dest_port):
+    # Flush and close a connection's log file once the connection is over
+    log_writer.close(log_file_name(source_ip, source_port, dest_ip, dest_port))
+
+def flush_logs():
+    # Block until everything queued so far has been written, e.g. before exiting
+    log_writer.flush()
 
 # Example usage:
 # write_to_log('127.0.0.1', '15334', '10.0.0.15', '80', 'This is a test message')
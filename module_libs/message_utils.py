@@ -0,0 +1,104 @@
+# Message Context
+# One message's data with decoded views computed on first use, so modules and libraries share them instead of each decoding it again,
+# and the splice edits that module API 2 transformers return instead of a modified copy of the message
+
+
+class MessageContext:
+    """
+    Handed to modules that declare module_context = True or module_api = 2, and accepted in place of the message
+    data by the module_libs decoders. Each view is computed the first time it is asked for and then shared by every
+    module that sees the same data. The engine starts a new context whenever a transformer may have changed the data.
+    A context belongs to one message on one thread, so it takes no locks.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.views = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def memo(self, key, compute):
+        """compute() the first time key is asked for, the stored result after that. Modules can share their own views this way."""
+        try:
+            return self.views[key]
+        except KeyError:
+            value = self.views[key] = compute()
+            return value
+
+    def as_bytes(self):
+        # Observers already get an immutable copy, only a transformer's bytearray needs one
+        return self.data if isinstance(self.data, bytes) else self.memo('bytes', lambda: bytes(self.data))
+
+    def as_memoryview(self):
+        """Zero-copy view for slicing, read-only since the data may be shared with other observers."""
+        # Over as_bytes(): a view on a transformer's bytearray would stop it from being resized
+        return self.memo('memoryview', lambda: memoryview(self.as_bytes()).toreadonly())
+
+    def text(self, encoding='utf-8', errors='replace'):
+        # A decode that fails under errors='strict' raises every time it is asked for, it isn't stored
+        return self.memo(('text', encoding, errors), lambda: self.data.decode(encoding, errors))
+
+    def lines(self, encoding='utf-8', errors='replace'):
+        """text() split into lines, without the line endings."""
+        return self.memo(('lines', encoding, errors), lambda: self.text(encoding, errors).splitlines())
+
+    def hex(self):
+        return self.memo('hex', self.data.hex)
+
+
+def apply_edits(data, edits):
+    """
+    Apply splice edits [(offset, length, replacement)] to data in one pass and return the result as a new bytearray.
+    Offsets refer to data as given; edits may come in any order but must not overlap. Raises ValueError otherwise.
+    """
+    view = memoryview(data)
+    pieces = []
+    position = 0
+    try:
+        # Insertions before a replacement at the same offset, whichever order they came in; stable, so insertions
+        # at the same offset keep their order
+        for offset, length, replacement in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+            if offset < position or length < 0 or offset + length > len(view):
+                raise ValueError(f"splice edit ({offset}, {length}) overlaps another edit or lies outside the {len(view)} byte message")
+            pieces.append(view[position:offset])
+            pieces.append(replacement)
+            position = offset + length
+        pieces.append(view[position:])
+        # join sizes the result once, where repeated bytes.replace() copies the whole message every time
+        return bytearray().join(pieces)
+    finally:
+        # The slices go too, so data can be resized again even while an error's traceback is kept
+        del pieces[:]
+        view.release()
+
+def replace_edits(data, old, new):
+    """Splice edits replacing every occurrence of old with new, the edit list counterpart of data.replace(old, new)."""
+    if isinstance(data, MessageContext):
+        data = data.data
+    if not old:
+        raise ValueError("replace_edits needs something to replace")
+    edits = []
+    offset = data.find(old)
+    while offset != -1:
+        edits.append((offset, len(old), new))
+        offset = data.find(old, offset + len(old))
+    return edits
+
+def module_api_2(function, observer):
+    """
+    Adapt a module_api = 2 module_function to the call the engine makes for module_context modules.
+    The module gets a read-only memoryview of the data instead of the data itself and returns None (or no edits) to
+    leave it unchanged, or a list of splice edits. Edits returned by an observer are ignored.
+    """
+    def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
+        view = memoryview(message_data).toreadonly()
+        try:
+            edits = function(message_num, source_ip, source_port, dest_ip, dest_port, view, context)
+        finally:
+            # A bytearray can't be resized (e.g. by a later module) while a view of it exists
+            view.release()
+        if not edits or observer:
+            return message_data
+        return apply_edits(message_data, edits)
+    return module_function
@@ -0,0 +1,103 @@
+# Metrics Endpoint
+# Proxy counters and module latencies served in the Prometheus text format from a small HTTP listener
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from profile_utils import bucket_upper
+from stats_utils import GAUGES
+
+# Module latency histogram bucket bounds, in seconds
+LATENCY_BOUNDS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def metric_name(counter):
+    """
+    Map a counter name to (metric name, labels, scale, type): bytes_client -> parley_bytes_total{side="client"},
+    signature_hits:modules_client/Creds -> parley_signature_hits_total{module="modules_client/Creds"}.
+    """
+    labels = {}
+    counter, _, module = counter.partition(':')
+    if module:
+        labels['module'] = module
+    for side in ('client', 'server'):
+        if counter.endswith('_' + side):
+            counter = counter[:-len(side) - 1]
+            labels['side'] = side
+    scale = 1
+    if counter.endswith('_us'):
+        # Microsecond totals are exposed in seconds
+        counter = counter[:-3] + '_seconds'
+        scale = 1e-6
+    if counter in GAUGES:
+        return f"parley_{counter}", labels, scale, 'gauge'
+    return f"parley_{counter}_total", labels, scale, 'counter'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in sorted(labels.items())) + '}'
+
+def render_metrics(snapshot, profiles=None):
+    """Render a counter snapshot, and optionally a module profile snapshot, as Prometheus text."""
+    metrics = {}
+    for counter, value in snapshot.items():
+        name, labels, scale, kind = metric_name(counter)
+        metrics.setdefault(name, (kind, []))[1].append((labels, value * scale))
+
+    active = snapshot.get('connections_accepted', 0) - snapshot.get('connections_closed', 0)
+    metrics['parley_active_connections'] = ('gauge', [({}, active)])
+
+    lines = []
+    for name in sorted(metrics):
+        kind, samples = metrics[name]
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(samples, key=lambda sample: sorted(sample[0].items())):
+            lines.append(f"{name}{format_labels(labels)} {value:g}" if isinstance(value, float) else f"{name}{format_labels(labels)} {value}")
+
+    if profiles:
+        lines.append("# TYPE parley_module_latency_seconds histogram")
+        for module, stats in sorted(profiles.items()):
+            label = format_labels({'module': module})[:-1]
+            buckets = sorted((bucket_upper(index) / 1e9, count) for index, count in stats['buckets'].items())
+            for bound in LATENCY_BOUNDS:
+                # Only profile buckets entirely at or below the bound, so no sample above le is counted
+                count = sum(count for high, count in buckets if high <= bound)
+                lines.append(f'parley_module_latency_seconds_bucket{label},le="{bound:g}"}} {count}')
+            lines.append(f'parley_module_latency_seconds_bucket{label},le="+Inf"}} {stats["calls"]}')
+            lines.append(f"parley_module_latency_seconds_sum{label}}} {stats['total_ns'] / 1e9:g}")
+            lines.append(f"parley_module_latency_seconds_count{label}}} {stats['calls']}")
+        for metric, key in (('parley_module_errors_total', 'errors'), ('parley_module_bytes_in_total', 'bytes_in'), ('parley_module_bytes_out_total', 'bytes_out')):
+            lines.append(f"# TYPE {metric} counter")
+            for module, stats in sorted(profiles.items()):
+                lines.append(f"{metric}{format_labels({'module': module})} {stats[key]}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(host, port, collect):
+    """
+    Serve GET /metrics on host:port from a daemon thread.
+    collect() returns (counter snapshot, module profile snapshot or None) for each scrape.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render_metrics(*collect()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are not worth a console line each
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,197 @@
+# Upstream Connection Helpers
+# Cached DNS resolution and happy-eyeballs style connects across every address of a target
+
+import asyncio
+import errno
+import selectors
+import socket
+import threading
+import time
+
+from stats_utils import counters
+
+# connect_ex() results that mean the non-blocking connect is under way
+CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+
+
+class DNSCache:
+    """
+    getaddrinfo() results cached for ttl seconds.
+    Concurrent lookups of the same name share a single resolver query.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # (host, port) -> (expires, addrinfos)
+        self._inflight = {}  # (host, port) -> Event set when the running lookup finishes
+
+    def lookup(self, host, port):
+        """Return the cached addresses for host:port, or None if they are missing or expired."""
+        entry = self._entries.get((host, port))
+        if entry and entry[0] > time.monotonic():
+            counters.incr('dns_cache_hits')
+            return entry[1]
+        return None
+
+    def resolve(self, host, port):
+        """Return the addresses for host:port, querying the resolver at most once per TTL."""
+        key = (host, port)
+        while True:
+            addrinfos = self.lookup(host, port)
+            if addrinfos is not None:
+                return addrinfos
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+            # Someone else is already asking, wait for their answer
+            event.wait()
+
+        try:
+            counters.incr('dns_lookups')
+            addrinfos = interleave_families(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            if self.ttl > 0:
+                self._entries[key] = (time.monotonic() + self.ttl, addrinfos)
+            return addrinfos
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    async def resolve_async(self, host, port):
+        """resolve() for the event loop, the resolver query runs in the default executor."""
+        addrinfos = self.lookup(host, port)
+        if addrinfos is not None:
+            return addrinfos
+        return await asyncio.get_running_loop().run_in_executor(None, self.resolve, host, port)
+
+
+def interleave_families(addrinfos):
+    """
+    Alternate address families (RFC 8305), keeping the resolver's preference order within each family.
+    A dead IPv6 path then costs one attempt, not all of them.
+    """
+    by_family = {}
+    for addrinfo in addrinfos:
+        by_family.setdefault(addrinfo[0], []).append(addrinfo)
+    families = list(by_family.values())
+    result = []
+    while any(families):
+        for family in families:
+            if family:
+                result.append(family.pop(0))
+    return result
+
+
+def happy_eyeballs_connect(addrinfos, timeout=10.0, delay=0.25):
+    """
+    Connect to the first address that answers.
+    A new attempt starts every `delay` seconds, or as soon as the previous one fails, until one succeeds.
+    Returns a connected blocking socket, raises the last error (or TimeoutError) if none connect.
+    """
+    if not addrinfos:
+        raise OSError("No addresses to connect to")
+
+    deadline = time.monotonic() + timeout
+    pending = list(addrinfos)
+    attempts = {}
+    errors = []
+    next_start = 0
+    selector = selectors.DefaultSelector()
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                raise TimeoutError(f"Connect timed out after {timeout}s")
+
+            if pending and (now >= next_start or not attempts):
+                family, type_, proto, _, sockaddr = pending.pop(0)
+                sock = socket.socket(family, type_, proto)
+                sock.setblocking(False)
+                result = sock.connect_ex(sockaddr)
+                if result == 0:
+                    attempts[sock] = sockaddr
+                    return finish_connect(sock, attempts)
+                if result not in CONNECT_IN_PROGRESS:
+                    errors.append(OSError(result, f"{errno.errorcode.get(result, result)} connecting to {sockaddr[0]}"))
+                    counters.incr('connect_failovers')
+                    sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                attempts[sock] = sockaddr
+                next_start = now + delay
+
+            wake = min(deadline, next_start) if pending else deadline
+            for key, events in selector.select(max(wake - now, 0)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    return finish_connect(sock, attempts)
+                errors.append(OSError(result, f"{errno.errorcode.get(result, result)} connecting to {attempts.pop(sock)[0]}"))
+                counters.incr('connect_failovers')
+                sock.close()
+                # Don't wait out the delay once an attempt has failed
+                next_start = 0
+        raise errors[-1]
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+
+def finish_connect(sock, attempts):
+    # The winning socket leaves the attempt set so it isn't closed with the losers
+    del attempts[sock]
+    sock.setblocking(True)
+    return sock
+
+
+async def happy_eyeballs_connect_async(addrinfos, timeout=10.0, delay=0.25):
+    """happy_eyeballs_connect() for the event loop, returns a connected non-blocking socket."""
+    if not addrinfos:
+        raise OSError("No addresses to connect to")
+
+    loop = asyncio.get_running_loop()
+
+    async def attempt(addrinfo):
+        family, type_, proto, _, sockaddr = addrinfo
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def race():
+        pending = list(addrinfos)
+        tasks = set()
+        errors = []
+        try:
+            while pending or tasks:
+                if pending:
+                    tasks.add(loop.create_task(attempt(pending.pop(0))))
+                done, _ = await asyncio.wait(tasks, timeout=delay if pending else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        # Any other attempt that also finished just now is closed, the rest are cancelled
+                        for other in done:
+                            if other is not task and other.exception() is None:
+                                other.result().close()
+                        return task.result()
+                    errors.append(task.exception())
+                    counters.incr('connect_failovers')
+            raise errors[-1]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    try:
+        return await asyncio.wait_for(race(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Connect timed out after {timeout}s") from None
@@ -0,0 +1,178 @@
+# Module Offload
+# Runs observer modules that declare module_offload in separate processes, so CPU-heavy decoding isn't bound by the GIL
+
+import signal
+import threading
+import time
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+
+from stats_utils import counters
+from console_utils import console_print
+from log_utils import write_to_log
+from profile_utils import profiles
+from message_utils import MessageContext, module_api_2
+
+
+# In an offload process: modules imported so far, and the output they produced for the current job
+worker_modules = {}
+worker_console = []
+worker_logs = []
+
+def record_console(message):
+    worker_console.append(str(message))
+
+def record_log(source_ip, source_port, dest_ip, dest_port, message):
+    worker_logs.append((source_ip, source_port, dest_ip, dest_port, message))
+
+def init_worker():
+    # Module output is collected and handed back to the proxy, which shows and logs it as usual.
+    # Modules are imported after this, so their console_print / write_to_log names are the recording ones.
+    import console_utils
+    import log_utils
+    console_utils.console_print = record_console
+    log_utils.write_to_log = record_log
+    # Ctrl-C is handled by the proxy, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_job(modules, message_num, source_ip, source_port, dest_ip, dest_port, data, shm_name=None, size=0):
+    """
+    Run modules [(label, module name, path)] on one message in an offload process.
+    Large messages arrive in the shared memory block shm_name instead of data.
+    Returns ([(label, elapsed ns, error or None)], console messages, log lines).
+    """
+    if shm_name:
+        shm = SharedMemory(shm_name)
+        try:
+            data = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+
+    results = []
+    context = None  # Shared by the modules that declare module_context
+    for label, module_name, path in modules:
+        started = time.perf_counter_ns()
+        error = None
+        try:
+            module = worker_modules.get(path)
+            if module is None:
+                spec = importlib.util.spec_from_file_location(module_name, path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                if getattr(module, 'module_api', 1) == 2:
+                    module.module_function = module_api_2(module.module_function, True)
+                worker_modules[path] = module
+            if getattr(module, 'module_context', False) or getattr(module, 'module_api', 1) == 2:
+                if context is None:
+                    context = MessageContext(data)
+                module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, data, context)
+            else:
+                module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, data)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append((label, time.perf_counter_ns() - started, error))
+
+    console = worker_console[:]
+    logs = worker_logs[:]
+    del worker_console[:], worker_logs[:]
+    return results, console, logs
+
+
+class OffloadPool:
+    """
+    Offload processes for observer modules, each with its own bounded queue.
+    Each connection sticks to one process, so its messages are observed, shown and logged in order.
+    """
+
+    def __init__(self, processes, queue_size, shm_min):
+        # Not plain fork: the proxy has threads running by now, and a forked child could inherit a held lock
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.executors = [self.new_executor() for _ in range(processes)]
+        self.queue_size = queue_size
+        self.shm_min = shm_min
+        self.pending = [0] * processes
+        self.lock = threading.Lock()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=1, mp_context=self.context, initializer=init_worker)
+
+    def submit(self, modules, message_num, source_ip, source_port, dest_ip, dest_port, data):
+        # Both directions of a connection hash to the same process
+        shard = (hash((source_ip, source_port)) ^ hash((dest_ip, dest_port))) % len(self.executors)
+        with self.lock:
+            if self.pending[shard] >= self.queue_size:
+                # Never hold up forwarding for an observer, drop the message instead
+                counters.incr('offload_drops')
+                return
+            self.pending[shard] += 1
+        counters.incr('offload_queue_depth')
+
+        executor = self.executors[shard]
+        shm = None
+        try:
+            if len(data) >= self.shm_min:
+                # One copy into shared memory rather than pickling the message through a pipe
+                shm = SharedMemory(create=True, size=len(data))
+                shm.buf[:len(data)] = data
+                future = executor.submit(run_job, modules, message_num, source_ip, source_port, dest_ip, dest_port, None, shm.name, len(data))
+                counters.incr('offload_shm_messages')
+            else:
+                future = executor.submit(run_job, modules, message_num, source_ip, source_port, dest_ip, dest_port, bytes(data))
+        except Exception as e:
+            self.release(shard, shm)
+            self.failed(shard, executor, modules, e)
+            return
+        future.add_done_callback(lambda future: self.finished(future, shard, executor, shm, modules, len(data)))
+
+    def release(self, shard, shm):
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        with self.lock:
+            self.pending[shard] -= 1
+        counters.incr('offload_queue_depth', -1)
+
+    def finished(self, future, shard, executor, shm, modules, size):
+        self.release(shard, shm)
+        try:
+            results, console, logs = future.result()
+        except Exception as e:
+            self.failed(shard, executor, modules, e)
+            return
+
+        counters.incr('offload_messages')
+        for message in console:
+            console_print(message)
+        for line in logs:
+            write_to_log(*line)
+        for label, elapsed, error in results:
+            if error:
+                console_print(f"Error in observer module {label}: {error}")
+                counters.incr('observer_errors')
+            profile = profiles.get(label)
+            if profile is not None:
+                # The modules run in the offload process, their timing comes back with the results
+                profile.record(elapsed, size, 0 if error else size, bool(error))
+
+    def failed(self, shard, executor, modules, error):
+        counters.incr('offload_errors')
+        console_print(f"Error offloading {', '.join(label for label, _, _ in modules)}: {error!r}")
+        if isinstance(error, BrokenProcessPool):
+            # The offload process died (killed, or crashed in a module), start a new one for this shard
+            with self.lock:
+                if self.executors[shard] is executor:
+                    self.executors[shard] = self.new_executor()
+
+    def close(self, timeout=5.0):
+        """Wait (up to timeout seconds) for queued messages to be observed, then stop the processes."""
+        deadline = time.monotonic() + timeout
+        while sum(self.pending) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Join the processes if they are idle, so their queues are cleaned up; don't wait on a module that is stuck
+        idle = not sum(self.pending)
+        for executor in self.executors:
+            executor.shutdown(wait=idle, cancel_futures=True)
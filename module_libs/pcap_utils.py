@@ -0,0 +1,224 @@
+# Packet Capture
+# Proxied traffic streamed to pcapng files as synthetic TCP/IP packets, for offline analysis in Wireshark or tshark
+
+import os
+import atexit
+import queue
+import socket
+import struct
+import threading
+import time
+
+LINKTYPE_RAW = 101  # Packets start with the IPv4 or IPv6 header
+
+# Each connection appears once per interface: the bytes as received, and the bytes as forwarded after the modules
+INTERFACE_RECEIVED = 0
+INTERFACE_FORWARDED = 1
+INTERFACE_NAMES = ('received', 'forwarded')
+
+# Payload per synthetic packet, keeps the IPv4 total length field in range
+MAX_SEGMENT = 65000
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# Initial sequence numbers of the synthetic conversations
+CLIENT_ISN = 1000
+SERVER_ISN = 5000
+
+
+def pad4(data):
+    return data + b'\0' * (-len(data) % 4)
+
+def pcapng_options(*options):
+    # (code, value) pairs followed by opt_endofopt
+    encoded = b''.join(struct.pack('<HH', code, len(value)) + pad4(value) for code, value in options)
+    return encoded + b'\0\0\0\0'
+
+def pcapng_block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack('<II', block_type, length) + body + struct.pack('<I', length)
+
+def section_header():
+    body = struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1) + pcapng_options((4, b'Parley'))
+    return pcapng_block(0x0A0D0D0A, body)
+
+def interface_description(name):
+    # if_tsresol 6: timestamps are in microseconds
+    body = struct.pack('<HHI', LINKTYPE_RAW, 0, 0) + pcapng_options((2, name.encode()), (9, b'\x06'))
+    return pcapng_block(1, body)
+
+def enhanced_packet(interface, timestamp_us, packet, comment=None):
+    body = struct.pack('<IIIII', interface, timestamp_us >> 32, timestamp_us & 0xffffffff, len(packet), len(packet)) + pad4(packet)
+    if comment:
+        body += pcapng_options((1, comment.encode()))
+    return pcapng_block(6, body)
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!10H', header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def tcp_packet(source, dest, source_port, dest_port, seq, ack, flags, payload=b''):
+    # TCP checksums are left at zero, Wireshark does not validate them by default
+    tcp = struct.pack('!HHIIBBHHH', source_port, dest_port, seq & 0xffffffff, ack & 0xffffffff, 5 << 4, flags, 65535, 0, 0)
+    if len(source) == 4:
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0x4000, 64, socket.IPPROTO_TCP, 0, source, dest)
+        ip = ip[:10] + struct.pack('!H', ip_checksum(ip)) + ip[12:]
+    else:
+        ip = struct.pack('!IHBB16s16s', 6 << 28, len(tcp) + len(payload), socket.IPPROTO_TCP, 64, source, dest)
+    return ip + tcp + payload
+
+def packed_addresses(client_ip, server_ip):
+    # Both ends of a synthetic packet need the same family, IPv4 becomes IPv4-mapped IPv6 when mixed with IPv6
+    if ':' in client_ip or ':' in server_ip:
+        # A link-local address keeps its %scope (e.g. fe80::1%eth0), which isn't part of the packet header
+        return tuple(socket.inet_pton(socket.AF_INET6, ip.partition('%')[0] if ':' in ip else '::ffff:' + ip) for ip in (client_ip, server_ip))
+    return socket.inet_aton(client_ip), socket.inet_aton(server_ip)
+
+
+class CaptureWriter:
+    """
+    Appends pcapng blocks to rotating capture files from a background thread.
+    Callers only queue the encoded blocks, so connection threads never wait on the disk.
+    """
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024, buffer_size=1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.pid = None
+        # Only touched by the writer thread
+        self.file = None
+        self.size = 0
+        self.sequence = 0
+
+    def start(self):
+        # Started on first use, and again in a forked child where the parent's thread does not exist
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name='capture-writer', daemon=True).start()
+
+    def write(self, blocks):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put(blocks)
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is written to the capture file."""
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            blocks = self.queue.get()
+            if isinstance(blocks, threading.Event):
+                if self.file:
+                    self.file.flush()
+                blocks.set()
+                continue
+            try:
+                if self.file is None or self.size >= self.max_size:
+                    self.rotate()
+                self.file.write(blocks)
+                self.size += len(blocks)
+            except OSError as e:
+                print(f"Error writing capture file: {e}")
+
+    def rotate(self):
+        if self.file:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        name = f"parley-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.sequence:04d}.pcapng"
+        self.file = open(os.path.join(self.directory, name), 'wb', buffering=self.buffer_size)
+        header = section_header() + b''.join(interface_description(interface) for interface in INTERFACE_NAMES)
+        self.file.write(header)
+        self.size = len(header)
+
+
+class CaptureFlow:
+    """
+    One proxied connection written as two synthetic TCP conversations, one per capture interface:
+    what each side sent to the proxy, and what the proxy forwarded after the modules ran.
+    """
+
+    def __init__(self, writer, client_ip, client_port, server_ip, server_port):
+        self.writer = writer
+        self.client = (client_ip, client_port)
+        client_address, server_address = packed_addresses(client_ip, server_ip)
+        self.endpoints = {
+            'client': (client_address, server_address, client_port, server_port),
+            'server': (server_address, client_address, server_port, client_port),
+        }
+        # Next sequence number per (interface, sending side)
+        self.seq = {}
+        blocks = []
+        timestamp = time.time_ns() // 1000
+        for interface in (INTERFACE_RECEIVED, INTERFACE_FORWARDED):
+            self.seq[interface, 'client'] = CLIENT_ISN
+            self.seq[interface, 'server'] = SERVER_ISN
+            blocks.append(self.segment(interface, 'client', timestamp, TCP_SYN))
+            blocks.append(self.segment(interface, 'server', timestamp, TCP_SYN | TCP_ACK))
+            blocks.append(self.segment(interface, 'client', timestamp, TCP_ACK))
+        self.writer.write(b''.join(blocks))
+
+    def side(self, source_ip, source_port):
+        return 'client' if (source_ip, source_port) == self.client else 'server'
+
+    def segment(self, interface, side, timestamp, flags, payload=b'', comment=None):
+        peer = 'server' if side == 'client' else 'client'
+        seq = self.seq[interface, side]
+        ack = self.seq[interface, peer]
+        self.seq[interface, side] = seq + len(payload) + (1 if flags & (TCP_SYN | TCP_FIN) else 0)
+        packet = tcp_packet(*self.endpoints[side], seq, ack if flags & TCP_ACK else 0, flags, payload)
+        return enhanced_packet(interface, timestamp, packet, comment)
+
+    def record(self, interface, side, data, comment):
+        timestamp = time.time_ns() // 1000
+        data = memoryview(data)
+        blocks = []
+        for offset in range(0, len(data), MAX_SEGMENT):
+            # The comment goes on the first packet of the message only
+            blocks.append(self.segment(interface, side, timestamp, TCP_PSH | TCP_ACK, bytes(data[offset:offset + MAX_SEGMENT]), comment if not offset else None))
+        self.writer.write(b''.join(blocks))
+
+    def received(self, side, message_num, data):
+        direction = 'Client to Server' if side == 'client' else 'Server to Client'
+        self.record(INTERFACE_RECEIVED, side, data, f"{direction} ({message_num})")
+
+    def tap(self, side, message_num, send, original):
+        """Wrap send() so what is forwarded is captured too, noting whether the modules changed it."""
+        direction = 'Client to Server' if side == 'client' else 'Server to Client'
+        original = bytes(original)
+
+        def forward(data):
+            note = " modified by modules" if data != original else ""
+            self.record(INTERFACE_FORWARDED, side, data, f"{direction} ({message_num}){note}")
+            send(data)
+        return forward
+
+    def close(self):
+        timestamp = time.time_ns() // 1000
+        blocks = []
+        for interface in (INTERFACE_RECEIVED, INTERFACE_FORWARDED):
+            blocks.append(self.segment(interface, 'client', timestamp, TCP_FIN | TCP_ACK))
+            blocks.append(self.segment(interface, 'server', timestamp, TCP_FIN | TCP_ACK))
+            blocks.append(self.segment(interface, 'client', timestamp, TCP_ACK))
+        self.writer.write(b''.join(blocks))
+
+
+def open_capture(directory, max_size):
+    """Return a CaptureWriter for directory, flushed at exit."""
+    writer = CaptureWriter(directory, max_size)
+    atexit.register(writer.flush)
+    return writer
@@ -0,0 +1,157 @@
+# Module Profiling
+# Per-module call latency histograms, call and error counts and bytes in/out, enabled with --profile
+
+import json
+import threading
+import time
+
+# Log-linear histogram: 2**SUB_BITS buckets per power of two, about 6% resolution
+SUB_BITS = 4
+SUB_MASK = (1 << SUB_BITS) - 1
+
+
+def bucket_index(value):
+    if value <= SUB_MASK:
+        return value
+    exponent = value.bit_length() - SUB_BITS - 1
+    return ((exponent + 1) << SUB_BITS) | ((value >> exponent) & SUB_MASK)
+
+def bucket_value(index):
+    # Lowest value that falls in the bucket
+    if index <= SUB_MASK:
+        return index
+    exponent = (index >> SUB_BITS) - 1
+    return ((index & SUB_MASK) | (1 << SUB_BITS)) << exponent
+
+def bucket_upper(index):
+    # Highest value that falls in the bucket
+    return bucket_value(index + 1) - 1
+
+def percentile(buckets, fraction, maximum=None):
+    """
+    Value at the given fraction (0-1) of a {bucket index: count} histogram: the upper bound of its bucket, so it
+    never reads low, capped at maximum (the largest value recorded) when given.
+    """
+    total = sum(buckets.values())
+    if not total:
+        return 0
+    rank = fraction * total
+    seen = 0
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if seen >= rank:
+            break
+    value = bucket_upper(index)
+    return min(value, maximum) if maximum is not None else value
+
+
+class ModuleProfile:
+    """Call statistics for one module."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = {}
+
+    def record(self, elapsed, bytes_in, bytes_out, failed):
+        index = bucket_index(elapsed)
+        with self.lock:
+            self.calls += 1
+            self.errors += failed
+            self.total_ns += elapsed
+            self.max_ns = max(self.max_ns, elapsed)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'calls': self.calls, 'errors': self.errors, 'total_ns': self.total_ns, 'max_ns': self.max_ns,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'buckets': dict(self.buckets)}
+
+
+# Module name -> ModuleProfile, only filled in when profiling is on
+profiles = {}
+
+
+def profile_module(name, module, load=None):
+    """
+    Replace module.module_function with a timed wrapper recording into profiles[name].
+    load, if given, is called before the timer starts, so a module imported on its first message doesn't have the import
+    counted as that call's latency.
+    """
+    profile = profiles[name] = ModuleProfile()
+    function = module.module_function
+
+    def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, *context):
+        if load is not None:
+            try:
+                load()
+            except BaseException:
+                profile.record(0, len(message_data), 0, True)
+                raise
+        started = time.perf_counter_ns()
+        try:
+            result = function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, *context)
+        except BaseException:
+            profile.record(time.perf_counter_ns() - started, len(message_data), 0, True)
+            raise
+        profile.record(time.perf_counter_ns() - started, len(message_data), len(result) if result is not None else 0, False)
+        return result
+
+    module.module_function = module_function
+
+def profile_snapshot():
+    """Return a plain dict of every module's statistics, safe to pickle or merge."""
+    return {name: profile.snapshot() for name, profile in list(profiles.items())}
+
+def merge_profiles(snapshots):
+    """Combine profile snapshots, e.g. from several worker processes."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, stats in snapshot.items():
+            total = merged.setdefault(name, {'calls': 0, 'errors': 0, 'total_ns': 0, 'max_ns': 0, 'bytes_in': 0, 'bytes_out': 0, 'buckets': {}})
+            for key in ('calls', 'errors', 'total_ns', 'bytes_in', 'bytes_out'):
+                total[key] += stats[key]
+            total['max_ns'] = max(total['max_ns'], stats['max_ns'])
+            for index, count in stats['buckets'].items():
+                total['buckets'][int(index)] = total['buckets'].get(int(index), 0) + count
+    return merged
+
+def summarize(stats):
+    calls = stats['calls']
+    return {
+        'calls': calls,
+        'errors': stats['errors'],
+        'mean_us': stats['total_ns'] / calls / 1000 if calls else 0,
+        'p50_us': percentile(stats['buckets'], 0.50, stats['max_ns']) / 1000,
+        'p99_us': percentile(stats['buckets'], 0.99, stats['max_ns']) / 1000,
+        'p999_us': percentile(stats['buckets'], 0.999, stats['max_ns']) / 1000,
+        'max_us': stats['max_ns'] / 1000,
+        'total_ms': stats['total_ns'] / 1e6,
+        'bytes_in': stats['bytes_in'],
+        'bytes_out': stats['bytes_out'],
+    }
+
+def format_profiles(snapshot):
+    """Format a profile snapshot as a table, the most expensive module (total time) first."""
+    columns = ('calls', 'errors', 'mean_us', 'p50_us', 'p99_us', 'p999_us', 'max_us', 'total_ms', 'bytes_in', 'bytes_out')
+    rows = sorted(((name, summarize(stats)) for name, stats in snapshot.items()), key=lambda row: -row[1]['total_ms'])
+    width = max([len('module')] + [len(name) for name, _ in rows])
+    lines = [f"{'module':<{width}} " + ' '.join(f"{column:>10}" for column in columns)]
+    for name, summary in rows:
+        cells = (f"{summary[column]:>10.1f}" if isinstance(summary[column], float) else f"{summary[column]:>10}" for column in columns)
+        lines.append(f"{name:<{width}} " + ' '.join(cells))
+    return '\n'.join(lines)
+
+def dump_profiles(snapshot, path):
+    """Write a profile snapshot (summaries plus the histogram buckets, keyed by their lowest value in ns) to a JSON file."""
+    data = {name: dict(summarize(stats), buckets_ns={str(bucket_value(index)): count for index, count in sorted(stats['buckets'].items())})
+            for name, stats in snapshot.items()}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
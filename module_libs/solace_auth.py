@@ -1,8 +1,10 @@
 import base64
 
+from message_utils import MessageContext
+
 def decode_base64_credentials(data):
     # Convert bytes to string for easier manipulation
-    data_str = data.decode('latin1')
+    data_str = data.text('latin-1') if isinstance(data, MessageContext) else data.decode('latin-1')
 
     # Find the start of the username (first base64 string)
     start_username = data_str.find('\x06')
@@ -0,0 +1,97 @@
+# Proxy Statistics
+# Lock-cheap counters shared by the connection engines, worker processes and reports
+
+import threading
+import weakref
+
+# Counters that go up and down rather than only up
+GAUGES = {'observer_queue_depth', 'offload_queue_depth', 'connections_waiting'}
+
+
+class _Shard(dict):
+    """Per-thread counter values, folded back into the owner when the thread exits."""
+
+    # Shards are tracked by identity, not by their contents
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+
+    def __init__(self, owner):
+        super().__init__()
+        self.owner = owner
+
+    def __del__(self):
+        try:
+            self.owner._retire(self)
+        except Exception:
+            pass
+
+
+class Counters:
+    """
+    Named integer counters.
+    Each thread increments its own shard without taking a lock; readers sum the shards.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = weakref.WeakSet()
+        self._retired = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _Shard(self)
+            with self._lock:
+                self._shards.add(shard)
+            self._local.shard = shard
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            for name, value in shard.items():
+                self._retired[name] = self._retired.get(name, 0) + value
+
+    def incr(self, name, amount=1):
+        shard = self._shard()
+        shard[name] = shard.get(name, 0) + amount
+
+    def snapshot(self):
+        """Return a dict of the current totals across all threads."""
+        with self._lock:
+            totals = dict(self._retired)
+            shards = list(self._shards)
+        for shard in shards:
+            for name, value in list(shard.items()):
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+def merge_snapshots(snapshots):
+    """Sum a list of counter snapshots into one dict."""
+    totals = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def retire_snapshot(snapshot):
+    """
+    The part of an exited worker's last snapshot that still counts towards the totals: its counters without its
+    gauges, and with all its connections counted as closed, since they went with it.
+    """
+    retired = {name: value for name, value in snapshot.items() if name not in GAUGES}
+    if retired.get('connections_accepted', 0) > retired.get('connections_closed', 0):
+        retired['connections_closed'] = retired['connections_accepted']
+    return retired
+
+
+def format_snapshot(snapshot):
+    """Format a counter snapshot as a single sorted 'name=value' line."""
+    return ' '.join(f"{name}={snapshot[name]}" for name in sorted(snapshot))
+
+
+# Process-wide counters used by parley.py
+counters = Counters()
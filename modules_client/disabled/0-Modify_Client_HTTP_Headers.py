@@ -4,10 +4,13 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
+from message_utils import replace_edits
 
 module_description = "Modify Client HTTP Headers"
+module_api = 2  # returns splice edits, applied to the message in one pass, rather than a modified copy
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Construct the output string
     output = []
@@ -16,15 +19,15 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     output.append(f"[{source_ip}:{source_port}->{dest_ip}:{dest_port}] {datetime.now().isoformat()} ------- Client to Server ({message_num}) Modify HTTP Headers -------")
 
     # Modify HTTP Headers
-    message_data = message_data.replace(b'Host: 127.0.0.1', b'Host: www.cnn.com')
-    message_data = message_data.replace(b'If-Modified-Since:', b'Invalid:')
-    message_data = message_data.replace(b'Accept-Encoding:', b'Invalid:')
+    edits = replace_edits(context, b'Host: 127.0.0.1', b'Host: www.cnn.com')
+    edits += replace_edits(context, b'If-Modified-Since:', b'Invalid:')
+    edits += replace_edits(context, b'Accept-Encoding:', b'Invalid:')
 
     # Join all lines with newline characters
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
-    return message_data
+    return edits
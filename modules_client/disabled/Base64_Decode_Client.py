@@ -3,20 +3,21 @@ from datetime import datetime
 import re
 import base64
 from log_utils import write_to_log
+from console_utils import console_print
 
 # Description of the module's purpose
 module_description = "Identify and decode Base64 strings in binary data for display and logging"
+module_role = "observer"  # only inspects the data, never modifies it
+module_offload = True  # CPU-heavy decoding, runs in the --offload_processes when they are enabled
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Define a regex pattern for Base64 strings
     base64_pattern = r'(?:[A-Za-z0-9+/]{4})+(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?'
     
     # Convert binary data to string for regex search (assuming ASCII-compatible)
-    try:
-        data_str = message_data.decode('ascii', errors='ignore')
-    except UnicodeDecodeError:
-        data_str = ''  # If decoding fails, skip string operations
+    data_str = context.text('ascii', 'ignore')
 
     # Find all potential Base64 strings
     potential_base64 = re.findall(base64_pattern, data_str)
@@ -44,7 +45,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
@@ -2,14 +2,18 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib_http_basic import format_basic_auth
 
 module_description = "capture and decode HTTP Basic Auth credentials from client requests"
+module_role = "observer"  # only inspects the data, never modifies it
+module_signatures = [b'authorization:']  # skip messages without an Authorization or Proxy-Authorization header
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Try to find and decode HTTP Basic auth
-    auth_output = format_basic_auth(message_data)
+    auth_output = format_basic_auth(context)
     
     # Only output if we found credentials
     if auth_output:
@@ -24,7 +28,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
         full_output = '\n'.join(output)
 
         # Atomic writes to screen and log file
-        print(full_output)
+        console_print(full_output)
         write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
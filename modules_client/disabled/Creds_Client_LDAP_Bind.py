@@ -2,11 +2,15 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib_ldap_bind import format_ldap_bind
 
 module_description = "capture and decode LDAP Simple Bind credentials from client"
+module_role = "observer"  # only inspects the data, never modifies it
+module_signatures = [b'\x60']  # skip messages without a BindRequest tag
+module_api = 2  # gets a read-only memoryview of the data, which the BER decoder reads in place
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Try to find and decode LDAP Simple Bind
     bind_output = format_ldap_bind(message_data)
@@ -24,7 +28,8 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
         full_output = '\n'.join(output)
 
         # Atomic writes to screen and log file
-        print(full_output)
+        console_print(full_output)
         write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
-    return message_data
+    # Nothing to change
+    return None
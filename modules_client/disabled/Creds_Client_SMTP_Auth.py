@@ -2,14 +2,18 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib_smtp_auth import format_smtp_auth
 
 module_description = "capture and decode SMTP/IMAP AUTH credentials from client"
+module_role = "observer"  # only inspects the data, never modifies it
+module_signatures = [b'plain', b'login']  # skip messages that can't hold an AUTH PLAIN or AUTH LOGIN exchange
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Try to find and decode SMTP/IMAP auth
-    auth_output = format_smtp_auth(message_data)
+    auth_output = format_smtp_auth(context)
     
     # Only output if we found credentials
     if auth_output:
@@ -24,7 +28,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
         full_output = '\n'.join(output)
 
         # Atomic writes to screen and log file
-        print(full_output)
+        console_print(full_output)
         write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
@@ -3,13 +3,14 @@
 from datetime import datetime
 from solace_auth import decode_base64_credentials
 from log_utils import write_to_log
+from console_utils import console_print
 
 module_description = "capture and decode Solace message broker authentication credentials"
+module_role = "observer"  # only inspects the data, never modifies it
+module_filter = {'message_num': 1}  # the login is the first message of the connection
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
-
-    if(message_num != 1):
-        return message_data
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Construct the output string
     output = []
@@ -18,14 +19,14 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     output.append(f"[{source_ip}:{source_port}->{dest_ip}:{dest_port}] {datetime.now().isoformat()} ------- Client to Server ({message_num}) CREDS CAPTURED -------")
 
     # Decode Base64 Authentication Credentials
-    decoded_creds = decode_base64_credentials(message_data)
+    decoded_creds = decode_base64_credentials(context)
     output.append(decoded_creds)
 
     # Join all lines with newline characters
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
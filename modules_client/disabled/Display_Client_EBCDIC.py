@@ -2,9 +2,11 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib3270 import ebcdic_to_ascii
 
 module_description = "print EBCDIC data on the screen from the client"
+module_role = "observer"  # only inspects the data, never modifies it
 
 def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
 
@@ -22,7 +24,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
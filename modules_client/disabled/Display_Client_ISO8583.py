@@ -2,9 +2,12 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib8583 import decode_iso8583
 
 module_description = "print ISO8583 data on the screen from the client"
+module_role = "observer"  # only inspects the data, never modifies it
+module_offload = True  # CPU-heavy decoding, runs in the --offload_processes when they are enabled
 
 def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
 
@@ -22,7 +25,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
@@ -2,14 +2,19 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib_jwt import find_and_format_jwts
 
 module_description = "extract and decode JWT Bearer tokens from client requests"
+module_role = "observer"  # only inspects the data, never modifies it
+module_signatures = [b'bearer', b'token', b'jwt']  # skip messages without a Bearer header or token field
+module_offload = True  # CPU-heavy decoding, runs in the --offload_processes when they are enabled
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Try to find and decode JWT tokens
-    jwt_output = find_and_format_jwts(message_data)
+    jwt_output = find_and_format_jwts(context)
     
     # Only output if we found tokens
     if jwt_output:
@@ -24,7 +29,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
         full_output = '\n'.join(output)
 
         # Atomic writes to screen and log file
-        print(full_output)
+        console_print(full_output)
         write_to_log(source_ip, source_port, dest_ip, dest_port, full_output)
 
     return message_data
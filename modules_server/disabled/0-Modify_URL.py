@@ -4,10 +4,13 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
+from message_utils import replace_edits
 
 module_description = "Modify some text"
+module_api = 2  # returns splice edits, applied to the message in one pass, rather than a modified copy
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Construct the output string
     output = []
@@ -16,13 +19,13 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     output.append(f"[{source_ip}:{source_port}->{dest_ip}:{dest_port}] {datetime.now().isoformat()} ------- Server to Client ({message_num}) Modify URL -------")
 
     # Modify Text
-    message_data = message_data.replace(b'https://www.cnn.com/', b'http://127.0.0.1/')
+    edits = replace_edits(context, b'https://www.cnn.com/', b'http://127.0.0.1/')
 
     # Join all lines with newline characters
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(dest_ip, dest_port, source_ip, source_port, full_output)
 
-    return message_data
+    return edits
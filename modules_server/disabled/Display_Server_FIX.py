@@ -2,11 +2,15 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 from lib_fix import format_fix_message
 
 module_description = "decode and display FIX protocol messages from the server"
+module_role = "observer"  # only inspects the data, never modifies it
+module_offload = True  # CPU-heavy decoding, runs in the --offload_processes when they are enabled
+module_context = True  # decodes through the shared message context
 
-def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context):
 
     # Construct the output string
     output = []
@@ -16,7 +20,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
 
     # Decode FIX message
     try:
-        fix_output = format_fix_message(message_data)
+        fix_output = format_fix_message(context)
         output.append(fix_output)
     except Exception as e:
         output.append(f"FIX decode error: {e}")
@@ -26,7 +30,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(dest_ip, dest_port, source_ip, source_port, full_output)
 
     return message_data
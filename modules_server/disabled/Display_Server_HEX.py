@@ -2,8 +2,10 @@
 
 from datetime import datetime
 from log_utils import write_to_log
+from console_utils import console_print
 
 module_description = "print HEX data on the screen from the server in hex dump format"
+module_role = "observer"  # only inspects the data, never modifies it
 
 def module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data):
 
@@ -23,7 +25,7 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
     full_output = '\n'.join(output)
 
     # Atomic writes to screen and log file
-    print(full_output)
+    console_print(full_output)
     write_to_log(dest_ip, dest_port, source_ip, source_port, full_output)
 
     return message_data
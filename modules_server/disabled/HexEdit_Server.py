@@ -5,6 +5,7 @@ import tempfile
 import subprocess
 import shutil
 from log_utils import write_to_log
+from console_utils import flush_console
 
 module_description = "Allow hex editing of server data before sending"
 
@@ -21,7 +22,8 @@ def module_function(message_num, source_ip, source_port, dest_ip, dest_port, mes
         with os.fdopen(fd, 'wb') as temp_file:
             temp_file.write(message_data)
        
-        # Launch hexedit on the temp file
+        # Launch hexedit on the temp file, after any queued console output so it doesn't land on the editor screen
+        flush_console()
         print(f"Opening hexedit for message {message_num}. Edit and save to proceed.")
         subprocess.run(['hexedit', temp_file_path])
        
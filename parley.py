@@ -18,13 +18,20 @@
 # ------------------------------------------------------------------------------------------------------------------
 
 import os
-import importlib.util
 import socket
 import ssl
 import sys
 import argparse
 import threading
-import select
+import selectors
+import asyncio
+import multiprocessing
+import queue
+import time
+import signal
+import collections
+import concurrent.futures
+import atexit
 
 VERSION = "1.2.0"
 TAGLINE = "Multi-Threaded Modular TCP Penetration Testing Proxy with TLS support"
@@ -36,107 +43,1241 @@ module_libs_path = os.path.join(os.path.dirname(__file__), 'module_libs')
 if module_libs_path not in sys.path:
     sys.path.insert(0, module_libs_path)
 
-def handle_client(client_socket, target_host, target_port, use_tls_client, use_tls_server, certfile, keyfile, cipher, ssl_version, client_certfile, client_keyfile, no_verify=False):
-    # Create a new socket for forwarding
-    forward_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    forward_socket.connect((target_host, target_port))
-    
-    # Get the client and server addresses
-    client_ip, client_port = client_socket.getpeername()
-    server_ip, server_port = forward_socket.getpeername()
-    
-    print(f"[+] Connected to server: {client_ip}:{client_port} -> {server_ip}:{server_port}")
-
-    if use_tls_server:
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        if no_verify:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-        if client_certfile and client_keyfile:
-            context.load_cert_chain(certfile=client_certfile, keyfile=client_keyfile)
-        if cipher:
-            context.set_ciphers(cipher)
-        if ssl_version:
-            context.options |= {
-                'TLSv1': ssl.OP_NO_TLSv1_1 | ssl.OP_NO_TLSv1_2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
-                'TLSv1.1': ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
-                'TLSv1.2': ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
-            }[ssl_version]
-        forward_socket = context.wrap_socket(forward_socket, server_hostname=target_host)
-
-    if use_tls_client:
-        client_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        if certfile and keyfile:
-            client_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-        client_socket = client_context.wrap_socket(client_socket, server_side=True)
+from stats_utils import counters, merge_snapshots, retire_snapshot, format_snapshot
+from log_utils import close_log, flush_logs
+from console_utils import configure_console, console_print, flush_console
+from pcap_utils import CaptureFlow, open_capture
+from framer_utils import make_framer, link_framers, HttpFramer
+from profile_utils import profile_module, profile_snapshot, merge_profiles, format_profiles, dump_profiles
+from metrics_utils import start_metrics_server
+from net_utils import DNSCache, happy_eyeballs_connect, happy_eyeballs_connect_async
+from loader_utils import read_manifest, import_module_file, LazyModule
+from signature_utils import SignatureIndex
+from filter_utils import compile_filters
+from offload_utils import OffloadPool
+from message_utils import MessageContext, module_api_2
 
-    sockets = [client_socket, forward_socket]
-    buffer_size = 4096  # Buffer size for receiving data
-    client_msg_num = 0
-    server_msg_num = 0
+def modules_timed():
+    # Module calls are timed for --profile and for the module latency metrics
+    return options is not None and (options.profile or bool(options.metrics_port))
+
+class LoadedModules(dict):
+    # One direction's enabled modules in run order, with their compiled module_filters and the index of their
+    # module_signatures if any declare them
+    filters = None
+    signatures = None
+    offloaded = {}  # Module name -> (label, module name, path) for observers that declare module_offload
+    contextual = frozenset()  # Names of the modules that declare module_context or module_api = 2
+
+def load_modules(modules_dir, verbose=True):
+    loaded_modules = LoadedModules()
+    side = os.path.basename(os.path.dirname(modules_dir))
+    for filename in sorted(os.listdir(modules_dir)):
+        if filename.endswith(".py") and filename != "__init__.py":
+            module_name = filename[:-3]
+
+            module_path = os.path.join(modules_dir, filename)
+
+            # Modules whose settings can be read from the source are imported when their first message arrives
+            started = time.perf_counter()
+            manifest = None if options is not None and options.eager_modules else read_manifest(module_path)
+            if manifest is not None:
+                module = LazyModule(module_name, module_path, manifest, on_import=lambda lazy, label=f"{side}/{module_name}":
+                                    console_print(f"[*] Imported {label} on its first message in {lazy.import_ms:.1f} ms"))
+                startup = f"manifest read in {(time.perf_counter() - started) * 1000:.1f} ms"
+            else:
+                module = import_module_file(module_name, module_path)
+                startup = f"imported in {(time.perf_counter() - started) * 1000:.1f} ms"
+
+            loaded_modules[module_name] = module
+
+            module_api = getattr(module, 'module_api', 1)
+            if module_api == 2:
+                # Called like a module_context module from here on, with the memoryview and splice edits handled by the wrapper
+                module.module_function = module_api_2(module.module_function, is_observer(module))
+            elif module_api != 1:
+                raise ValueError(f"{side}/{module_name}: module_api must be 1 or 2, not {module_api!r}")
+
+            if modules_timed():
+                # Timed wrapper, only installed when profiling so there is no cost otherwise
+                # A lazily imported module reports its import time on its own (on_import above)
+                profile_module(f"{side}/{module_name}", module, module.load if isinstance(module, LazyModule) else None)
+
+            if verbose:
+                print(f"\t<-> {module_name} - {module.module_description} ({startup})")
+
+    offloaded = {}
+    for module_name, module in loaded_modules.items():
+        if getattr(module, 'module_offload', False):
+            if is_observer(module):
+                path = module.path if isinstance(module, LazyModule) else module.__file__
+                offloaded[module_name] = (f"{side}/{module_name}", module_name, os.path.abspath(path))
+            elif verbose:
+                print(f"\t[!] {module_name} declares module_offload but is not an observer, it runs in the proxy")
+    if offloaded:
+        loaded_modules.offloaded = offloaded
+    contextual = {module_name for module_name, module in loaded_modules.items()
+                  if getattr(module, 'module_context', False) or getattr(module, 'module_api', 1) == 2}
+    if contextual:
+        loaded_modules.contextual = frozenset(contextual)
+    filters = compile_filters(loaded_modules, side)
+    if filters:
+        loaded_modules.filters = filters
+    signatures = SignatureIndex(loaded_modules, side)
+    if signatures.modules:
+        loaded_modules.signatures = signatures
+    return loaded_modules
+
+# Command line options, set in __main__ and read by the engines for their tuning knobs
+options = None
+
+def is_observer(module):
+    # Observer modules only look at the data and always return it unchanged
+    return getattr(module, 'module_role', 'transformer') == 'observer'
+
+def has_transformers(loaded_modules):
+    return any(not is_observer(module) for module in loaded_modules.values())
+
+def skip_module(loaded_modules, module_name, found, done, message_num, source_ip, source_port, dest_ip, dest_port, message_data):
+    """
+    Check a module's module_filter, then its module_signatures, against a message.
+    Returns (skip, found), found being the signature scan of message_data to reuse for the next modules until the data changes.
+    """
+    module_filter = loaded_modules.filters.get(module_name) if loaded_modules.filters else None
+    if module_filter and not module_filter.applies(module_name, done, message_num, source_ip, source_port, dest_ip, dest_port, len(message_data)):
+        return True, found
+    signatures = loaded_modules.signatures
+    if signatures and module_name in signatures.modules:
+        if found is None:
+            found = signatures.scan(message_data)
+        if not signatures.matches(module_name, found):
+            return True, found
+    if module_filter and module_filter.once and done is not None:
+        done.add(module_name)
+    return False, found
+
+def run_modules(loaded_modules, message_num, source_ip, source_port, dest_ip, dest_port, message_data, done=None):
+    # Pass the message through every loaded module in order, each one receiving the output of the last
+    selective = loaded_modules.filters or loaded_modules.signatures
+    offloaded = loaded_modules.offloaded if offload_pool else None
+    contextual = loaded_modules.contextual
+    found = None
+    context = None
+    queued = []
+    for module_name, module in loaded_modules.items():
+        if selective:
+            skip, found = skip_module(loaded_modules, module_name, found, done, message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+            if skip:
+                continue
+        if offloaded and module_name in offloaded:
+            queued.append(offloaded[module_name])
+            continue
+        if queued and not is_observer(module):
+            # The offloaded observers see the data as it stands before this transformer
+            offload_pool.submit(queued, message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+            queued = []
+        if module_name in contextual:
+            if context is None:
+                context = MessageContext(message_data)
+            message_data = module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, context)
+        else:
+            message_data = module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+        if not is_observer(module):
+            # The signatures are scanned, and the context's views computed, again once a transformer may have changed the data
+            found = context = None
+    if queued:
+        offload_pool.submit(queued, message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+    return message_data
+
+class ObserverPool:
+    # Worker threads running observer modules off the forwarding path.
+    # Each connection sticks to one worker, so its messages are observed in order.
+
+    # Seconds between console warnings about dropped messages
+    DROP_WARNING_INTERVAL = 5.0
+
+    def __init__(self, threads, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(threads)]
+        self.queue_size = queue_size
+        self.drops = 0  # Since the last warning
+        self.last_warning = None
+        self.lock = threading.Lock()
+        for number, jobs in enumerate(self.queues):
+            threading.Thread(target=self.run, args=(jobs,), name=f'observer-{number}', daemon=True).start()
+
+    def submit(self, observed, message_num, source_ip, source_port, dest_ip, dest_port):
+        # Both directions of a connection hash to the same worker
+        shard = (hash((source_ip, source_port)) ^ hash((dest_ip, dest_port))) % len(self.queues)
+        try:
+            self.queues[shard].put_nowait((observed, message_num, source_ip, source_port, dest_ip, dest_port))
+        except queue.Full:
+            # Never hold up forwarding for an observer, drop the message instead
+            counters.incr('observer_drops')
+            self.warn_drop()
+            return
+        counters.incr('observer_queue_depth')
+
+    def warn_drop(self):
+        # Dropped messages may hold credentials, so they are never dropped silently
+        with self.lock:
+            self.drops += 1
+            now = time.monotonic()
+            if self.last_warning is not None and now - self.last_warning < self.DROP_WARNING_INTERVAL:
+                return
+            drops, self.drops, self.last_warning = self.drops, 0, now
+        console_print(f"[!] {drops} message(s) not observed: an observer thread is {self.queue_size} messages behind "
+                      f"(raise --observer_queue, or use --observer_threads 0 to observe every message inline)")
+
+    def run(self, jobs):
+        while True:
+            observed, message_num, source_ip, source_port, dest_ip, dest_port = jobs.get()
+            counters.incr('observer_queue_depth', -1)
+            counters.incr('observer_messages')
+            for module, snapshot, context in observed:
+                try:
+                    if context is None:
+                        module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, snapshot)
+                    else:
+                        module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, snapshot, context)
+                except Exception as e:
+                    console_print(f"Error in observer module {module.__name__}: {e}")
+                    counters.incr('observer_errors')
+
+# Set up by run_proxy when --observer_threads is given, otherwise observers run inline
+observer_pool = None
+
+# Set up by run_proxy when --offload_processes is used, for observers that declare module_offload
+offload_pool = None
+
+# Set up by run_proxy when --capture_dir is used
+capture_writer = None
+
+def process_message(loaded_modules, transforms, send, message_num, source_ip, source_port, dest_ip, dest_port, message_data, capture=None, done=None):
+    if capture is not None:
+        # Capture the message as received, and as forwarded once the modules have run
+        side = capture.side(source_ip, source_port)
+        capture.received(side, message_num, message_data)
+        send = capture.tap(side, message_num, send, message_data)
+
+    if observer_pool is None:
+        if transforms:
+            send(run_modules(loaded_modules, message_num, source_ip, source_port, dest_ip, dest_port, message_data, done))
+        else:
+            # Nothing in this direction can change the data, so forward it before the observers look at it
+            send(message_data)
+            run_modules(loaded_modules, message_num, source_ip, source_port, dest_ip, dest_port, message_data, done)
+        return
+
+    # Only the transformers run before the data is sent; each observer is queued with an immutable
+    # copy of the data as it stands at its place in the module order, and the observers that declare
+    # module_context share one context per copy
+    observed = []
+    offloads = []  # [snapshot, [offloaded modules]] for observers run by the offload processes
+    snapshot = None
+    selective = loaded_modules.filters or loaded_modules.signatures
+    offloaded = loaded_modules.offloaded if offload_pool else None
+    contextual = loaded_modules.contextual
+    found = None
+    context = None
+    for module_name, module in loaded_modules.items():
+        if selective:
+            skip, found = skip_module(loaded_modules, module_name, found, done, message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+            if skip:
+                continue
+        if is_observer(module):
+            if snapshot is None:
+                snapshot = bytes(message_data)
+            if offloaded and module_name in offloaded:
+                if not offloads or offloads[-1][0] is not snapshot:
+                    offloads.append([snapshot, []])
+                offloads[-1][1].append(offloaded[module_name])
+            elif module_name in contextual:
+                if context is None:
+                    context = MessageContext(snapshot)
+                observed.append((module, snapshot, context))
+            else:
+                observed.append((module, snapshot, None))
+        else:
+            if module_name in contextual:
+                message_data = module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data, MessageContext(message_data))
+            else:
+                message_data = module.module_function(message_num, source_ip, source_port, dest_ip, dest_port, message_data)
+            snapshot = None
+            found = None
+            context = None
+    send(message_data)
+    if observed:
+        observer_pool.submit(observed, message_num, source_ip, source_port, dest_ip, dest_port)
+    for snapshot, queued in offloads:
+        offload_pool.submit(queued, message_num, source_ip, source_port, dest_ip, dest_port, snapshot)
+
+def create_server_context(cipher, ssl_version, client_certfile, client_keyfile, no_verify=False):
+    # TLS context for the connection from Parley to the target server
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    if no_verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if client_certfile and client_keyfile:
+        context.load_cert_chain(certfile=client_certfile, keyfile=client_keyfile)
+    if cipher:
+        context.set_ciphers(cipher)
+    if ssl_version:
+        context.options |= {
+            'TLSv1': ssl.OP_NO_TLSv1_1 | ssl.OP_NO_TLSv1_2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
+            'TLSv1.1': ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
+            'TLSv1.2': ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 | ssl.OP_NO_SSLv3 | ssl.OP_NO_SSLv2,
+        }[ssl_version]
+    return context
+
+# Most recent TLS session per upstream target, offered on the next connection so the handshake can resume
+tls_sessions = {}
+
+def save_tls_session(target, tls_socket):
+    session = tls_socket.session
+    if session is not None and (session.has_ticket or session.id):
+        tls_sessions[target] = session
+
+def create_client_context(certfile, keyfile):
+    # TLS context for the connection from the client to Parley
+    client_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    if certfile and keyfile:
+        client_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return client_context
+
+# Poll has no FD_SETSIZE limit and needs no extra descriptor per connection, fall back to select where missing
+ProxySelector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+# Errors a non-blocking plain or TLS socket raises when it cannot make progress right now
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+class ReceiveBuffer:
+    # Reusable receive buffer that grows while reads keep filling it and shrinks back once traffic is light
+
+    SHRINK_AFTER = 8  # Consecutive light reads before the buffer is halved
+
+    def __init__(self, initial_size, max_size):
+        self.initial_size = initial_size
+        self.max_size = max(initial_size, max_size)
+        self.light_reads = 0
+        self.resize(initial_size)
+
+    def resize(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def update(self, nbytes):
+        # Adapt the size to the read that just completed
+        if nbytes >= self.size and self.size < self.max_size:
+            self.light_reads = 0
+            self.resize(min(self.size * 2, self.max_size))
+        elif nbytes <= self.size // 4 and self.size > self.initial_size:
+            self.light_reads += 1
+            if self.light_reads >= self.SHRINK_AFTER:
+                self.light_reads = 0
+                self.resize(max(self.size // 2, self.initial_size))
+        else:
+            self.light_reads = 0
+
+def receive_limit(sock):
+    # Grow receive buffers up to the kernel receive buffer, nothing larger can arrive in one read
+    if options.max_buffer_size:
+        return options.max_buffer_size
+    try:
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    except OSError:
+        return 65536
+
+class ProxyDirection:
+    # One direction of a threads-engine connection: bytes read from src are queued until dst will take them
+
+    def __init__(self, name, src, dst, loaded_modules, source, dest):
+        self.name = name  # 'client' or 'server', the side the data comes from
+        self.src = src
+        self.dst = dst
+        self.loaded_modules = loaded_modules
+        self.transforms = has_transformers(loaded_modules)
+        self.source = source
+        self.dest = dest
+        self.message_num = 0
+        self.out = bytearray()
+        self.pipe = None  # (read fd, write fd) when this direction is spliced kernel-side
+        self.piped = 0  # Bytes waiting in the splice pipe
+        self.eof = False  # src has closed
+        self.shut = False  # The close has been passed on to dst
+        self.paused_at = None
+        self.reverse = None  # The other direction of the same connection
+        self.capture = None  # CaptureFlow shared by both directions when capturing
+        self.done = set()  # Modules with a once filter that have already run on this direction
+        self.framer = make_framer(getattr(options, f'framer_{name}'), options.max_message_size)
+        self.receive_buffer = ReceiveBuffer(options.buffer_size, min(receive_limit(src), options.max_message_size))
+
+    def want_read(self):
+        if self.pipe:
+            return not self.eof and not self.piped
+        return not self.eof and self.paused_at is None
+
+    def want_write(self):
+        return bool(self.out) or self.piped > 0
+
+    def queue(self, data):
+        self.out += data
+        if self.paused_at is None and len(self.out) >= options.high_water:
+            # dst is not keeping up, stop reading from src until it drains
+            self.paused_at = time.monotonic_ns()
+            counters.incr(f'backpressure_events_{self.name}')
+
+    def read(self):
+        if self.pipe:
+            try:
+                moved = os.splice(self.src.fileno(), self.pipe[1], 65536, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return
+            if not moved:
+                self.eof = True
+                return
+            self.piped += moved
+            counters.incr(f'bytes_{self.name}', moved)
+            counters.incr('bytes_spliced', moved)
+            return
+
+        # A message is whatever is available right now, capped at max_message_size
+        full_data = bytearray()
+        receive_buffer = self.receive_buffer
+        while len(full_data) < options.max_message_size:
+            size = min(receive_buffer.size, options.max_message_size - len(full_data))
+            try:
+                nbytes = self.src.recv_into(receive_buffer.view[:size], size)
+            except WOULD_BLOCK:
+                break
+            except ssl.SSLError:
+                # TLS peers may answer our half-close with an alert instead of their remaining data and a close
+                if not self.reverse.shut:
+                    raise
+                nbytes = 0
+            if not nbytes:  # The socket has closed
+                self.eof = True
+                break
+            full_data += receive_buffer.view[:nbytes]
+            receive_buffer.update(nbytes)
+
+            # A short read drained a plain socket, TLS returns one record per read so keep going until it would block
+            if nbytes < size and not isinstance(self.src, ssl.SSLSocket):
+                break
+
+        if len(full_data) >= options.max_message_size:
+            counters.incr(f'messages_capped_{self.name}')
+
+        messages = []
+        if full_data:
+            counters.incr(f'bytes_{self.name}', len(full_data))
+            messages = self.framer.feed(full_data) if self.framer else [full_data]
+        if self.eof and self.framer:
+            # Whatever the framer still holds goes out as a last, incomplete message
+            messages += self.framer.flush()
+
+        for message in messages:
+            self.message_num = self.message_num + 1
+            counters.incr(f'messages_{self.name}')
+            process_message(self.loaded_modules, self.transforms, self.queue, self.message_num, *self.source, *self.dest, message, self.capture, self.done)
+
+    def flush(self):
+        # Write as much as dst will take without blocking
+        if self.piped:
+            try:
+                self.piped -= os.splice(self.pipe[0], self.dst.fileno(), self.piped, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                pass
+        while self.out:
+            try:
+                sent = self.dst.send(self.out)
+            except WOULD_BLOCK:
+                break
+            del self.out[:sent]
+
+        if self.paused_at is not None and len(self.out) <= options.low_water:
+            counters.incr(f'backpressure_us_{self.name}', (time.monotonic_ns() - self.paused_at) // 1000)
+            self.paused_at = None
+
+        if self.eof and not self.shut and not self.want_write():
+            # Pass the half-close on once everything read from src has been delivered
+            self.shut = True
+            try:
+                # socket.socket.shutdown, because SSLSocket.shutdown would also drop the TLS layer for reading
+                socket.socket.shutdown(self.dst, socket.SHUT_WR)
+            except OSError:
+                pass
+
+# Resolved target addresses, shared by every connection (--dns_ttl)
+dns_cache = DNSCache()
+
+def connect_upstream(target_host, target_port, server_context=None):
+    # Connect to whichever of the target's addresses answers first
+    started = time.monotonic_ns()
+    addrinfos = dns_cache.resolve(target_host, target_port)
+    forward_socket = happy_eyeballs_connect(addrinfos, options.connect_timeout, options.connect_delay)
+    counters.incr('connects')
+    counters.incr('connect_us', (time.monotonic_ns() - started) // 1000)
+
+    if server_context:
+        started = time.monotonic_ns()
+        forward_socket = server_context.wrap_socket(forward_socket, server_hostname=target_host, session=tls_sessions.get((target_host, target_port)))
+        counters.incr('tls_handshakes_server')
+        counters.incr('tls_handshake_us_server', (time.monotonic_ns() - started) // 1000)
+        if forward_socket.session_reused:
+            counters.incr('tls_resumed_server')
+        save_tls_session((target_host, target_port), forward_socket)
+
+    return forward_socket
+
+def open_upstream(target_host, target_port, server_context=None, upstream_pool=None):
+    # Take a pre-connected upstream socket from the pool when there is one, otherwise connect now
+    forward_socket = upstream_pool.acquire() if upstream_pool else None
+    if forward_socket is None:
+        forward_socket = connect_upstream(target_host, target_port, server_context)
+    return forward_socket
+
+def accept_tls(client_socket, client_context):
+    # Server-side TLS handshake with the client
+    started = time.monotonic_ns()
+    client_socket = client_context.wrap_socket(client_socket, server_side=True)
+    counters.incr('tls_handshakes_client')
+    counters.incr('tls_handshake_us_client', (time.monotonic_ns() - started) // 1000)
+    if client_socket.session_reused:
+        counters.incr('tls_resumed_client')
+    return client_socket
+
+# Threads that open upstream connections while connection threads run the client TLS handshake, set up by start_proxy
+upstream_executor = None
+
+def upstream_alive(sock):
+    # Peek at the raw socket (below any TLS layer): no data yet means idle, an empty read means the server closed it
+    try:
+        sock.setblocking(False)
+        try:
+            data = socket.socket.recv(sock, 1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(True)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return bool(data)
+
+class UpstreamPool:
+    # Idle pre-connected (and TLS handshaken) upstream sockets, refilled in the background
+
+    def __init__(self, size, target_host, target_port, server_context=None, max_idle=30):
+        self.size = size
+        self.target_host = target_host
+        self.target_port = target_port
+        self.server_context = server_context
+        self.max_idle = max_idle
+        self.idle = collections.deque()  # (socket, time it was connected)
+        self.condition = threading.Condition()
+        threading.Thread(target=self.maintain, daemon=True).start()
+
+    def acquire(self):
+        # Returns a live upstream socket, or None when the pool is empty
+        with self.condition:
+            while self.idle:
+                sock, connected_at = self.idle.popleft()
+                self.condition.notify()
+                if upstream_alive(sock):
+                    counters.incr('pool_hits')
+                    return sock
+                sock.close()
+                counters.incr('pool_dropped')
+        counters.incr('pool_misses')
+        return None
+
+    def check_idle(self):
+        # Drop idle sockets the server has closed or that have been idle too long
+        now = time.monotonic()
+        for entry in list(self.idle):
+            sock, connected_at = entry
+            if now - connected_at > self.max_idle or not upstream_alive(sock):
+                self.idle.remove(entry)
+                sock.close()
+                counters.incr('pool_dropped')
+
+    def maintain(self):
+        while True:
+            with self.condition:
+                self.check_idle()
+                if len(self.idle) >= self.size:
+                    self.condition.wait(timeout=1.0)
+                    continue
+            try:
+                sock = connect_upstream(self.target_host, self.target_port, self.server_context)
+            except OSError:
+                counters.incr('pool_connect_errors')
+                time.sleep(1.0)
+                continue
+            with self.condition:
+                self.idle.append((sock, time.monotonic()))
+
+class Admission:
+    # Connection limits checked as each connection is accepted: running plus queued, and per source IP
+
+    def __init__(self, max_connections, max_queue=0, max_per_ip=0):
+        self.max_connections = max_connections
+        self.max_queue = max_queue
+        self.max_per_ip = max_per_ip
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.per_ip = collections.Counter()
+
+    def admit(self, ip):
+        # True if the connection may run (now or once a slot frees up), False to reject it
+        with self.lock:
+            if self.max_per_ip and self.per_ip[ip] >= self.max_per_ip:
+                counters.incr('connections_rejected_per_ip')
+                return False
+            if self.admitted >= self.max_connections + self.max_queue:
+                counters.incr('connections_rejected')
+                return False
+            if self.admitted >= self.max_connections:
+                counters.incr('connections_queued')
+            self.admitted += 1
+            self.per_ip[ip] += 1
+            return True
+
+    def release(self, ip):
+        with self.lock:
+            self.admitted -= 1
+            self.per_ip[ip] -= 1
+            if not self.per_ip[ip]:
+                del self.per_ip[ip]
+
+class HandlerPool:
+    # At most `size` connection handler threads, started on demand and reused; extra connections wait their turn
+
+    def __init__(self, size):
+        self.size = size
+        self.condition = threading.Condition()
+        self.jobs = collections.deque()
+        self.threads = 0
+        self.busy = 0
+
+    def submit(self, function, *args):
+        with self.condition:
+            if self.busy + len(self.jobs) >= self.threads and self.threads < self.size:
+                self.threads += 1
+                threading.Thread(target=self.run, name=f'handler-{self.threads}', daemon=True).start()
+            self.jobs.append((function, args))
+            counters.incr('connections_waiting')
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                function, args = self.jobs.popleft()
+                self.busy += 1
+            counters.incr('connections_waiting', -1)
+            try:
+                function(*args)
+            except Exception as e:
+                console_print(f"Error in connection handler: {e}")
+            finally:
+                with self.condition:
+                    self.busy -= 1
+
+def reject_connection(client_socket, client_ip, client_port):
+    console_print(f"[-] Rejected connection from {client_ip}:{client_port} (connection limit reached)")
+    counters.incr('connections_closed')
+    client_socket.close()
+
+def serve_client(admission, client_ip, client_socket, *args):
+    # Run one connection in a handler thread and give its admission back afterwards
+    try:
+        handle_client(client_socket, *args)
+    finally:
+        admission.release(client_ip)
+
+def handle_client(client_socket, target_host, target_port, client_context=None, server_context=None, upstream_pool=None):
+    started = time.monotonic_ns()
+    try:
+        if client_context:
+            # Connect upstream while the client handshake runs, so setup costs the longer of the two rather than their sum
+            upstream = upstream_executor.submit(open_upstream, target_host, target_port, server_context, upstream_pool)
+            try:
+                client_socket = accept_tls(client_socket, client_context)
+            except Exception:
+                upstream.add_done_callback(lambda future: future.exception() is None and future.result().close())
+                raise
+            forward_socket = upstream.result()
+        else:
+            forward_socket = open_upstream(target_host, target_port, server_context, upstream_pool)
+    except Exception as e:
+        console_print(f"Error in connection setup: {e}")
+        counters.incr('connection_errors')
+        counters.incr('connections_closed')
+        client_socket.close()
+        return
+    counters.incr('setups')
+    counters.incr('setup_us', (time.monotonic_ns() - started) // 1000)
     
+    sockets = [client_socket, forward_socket]
     try:
-        while sockets:
-            readable, writable, errored = select.select(sockets, [], [])
-            for s in readable:
-                full_data = bytearray()
-                while True:
-                    # Read data in chunks
-                    data = s.recv(buffer_size)
-                    if not data:  # No more data to read
-                        break
-                    full_data.extend(data)
-                    
-                    # If we've read less than the buffer size, it means we've read all available data
-                    if len(data) < buffer_size:
-                        break
-                
-                if full_data:
-                    if s is client_socket:
-                        client_msg_num = client_msg_num + 1
-                        for module_name, module in loaded_modules_client.items():
-                            full_data = module.module_function(client_msg_num, client_ip, client_port, server_ip, server_port, full_data)
-                        forward_socket.sendall(full_data)
-                    else:
-                        server_msg_num = server_msg_num + 1
-                        for module_name, module in loaded_modules_server.items():
-                            full_data = module.module_function(server_msg_num, server_ip, server_port, client_ip, client_port, full_data)
-                        client_socket.sendall(full_data)
-                else:
-                    # If no data, the socket has closed
-                    sockets.remove(s)
-                    s.close()
-                    if len(sockets) == 0:
-                        break  # Both sockets closed, connection ended
+        # Get the client and server addresses (either end can already be gone, e.g. a client that reset during setup)
+        client_ip, client_port = client_socket.getpeername()
+        server_ip, server_port = forward_socket.getpeername()[:2]
+
+        directions = [
+            ProxyDirection('client', client_socket, forward_socket, loaded_modules_client, (client_ip, client_port), (server_ip, server_port)),
+            ProxyDirection('server', forward_socket, client_socket, loaded_modules_server, (server_ip, server_port), (client_ip, client_port)),
+        ]
+        directions[0].reverse, directions[1].reverse = directions[1], directions[0]
+        directions[0].framer, directions[1].framer = link_framers(directions[0].framer, directions[1].framer, options.max_message_size)
+
+        capture = CaptureFlow(capture_writer, client_ip, client_port, server_ip, server_port) if capture_writer else None
+        if capture:
+            for direction in directions:
+                direction.capture = capture
+    except Exception as e:
+        console_print(f"Error in connection setup: {e}")
+        counters.incr('connection_errors')
+        counters.incr('connections_closed')
+        for sock in sockets:
+            sock.close()
+        return
+
+    console_print(f"[+] Connected to server: {client_ip}:{client_port} -> {server_ip}:{server_port}")
+
+    # Directions with no modules at all are spliced kernel-side when both ends are plain TCP (and nothing is captured)
+    if hasattr(os, 'splice') and not options.no_splice and not client_context and not server_context and not capture_writer:
+        for direction in directions:
+            # The server's http framer follows the client's requests, so those have to pass through Python
+            if not direction.loaded_modules and not (direction is directions[0] and isinstance(directions[1].framer, HttpFramer)):
+                direction.pipe = os.pipe()
+
+    selector = ProxySelector()
+    registered = {}
+
+    try:
+        for sock in sockets:
+            sock.setblocking(False)
+
+        while not all(direction.shut for direction in directions):
+            # Read from a side only while its direction has room, write to a side only while data is queued for it
+            interest = {sock: 0 for sock in sockets}
+            for direction in directions:
+                if direction.want_read():
+                    interest[direction.src] |= selectors.EVENT_READ
+                if direction.want_write():
+                    interest[direction.dst] |= selectors.EVENT_WRITE
+            for sock, events in interest.items():
+                if events and sock not in registered:
+                    selector.register(sock, events)
+                elif events and registered[sock] != events:
+                    selector.modify(sock, events)
+                elif not events and sock in registered:
+                    selector.unregister(sock)
+                    del registered[sock]
+                    continue
+                if events:
+                    registered[sock] = events
+
+            # TLS sockets can hold already decrypted bytes that the poller cannot see
+            pending = {direction.src for direction in directions if direction.want_read() and getattr(direction.src, 'pending', None) and direction.src.pending()}
+            readable = set(pending)
+            for key, events in selector.select(0 if pending else None):
+                if events & selectors.EVENT_READ:
+                    readable.add(key.fileobj)
+
+            for direction in directions:
+                if direction.src in readable and direction.want_read():
+                    direction.read()
+                direction.flush()
     except OSError as e:
         if e.errno == 9:  # Errno 9 is "Bad file descriptor"
-            print(f"[-] Connection broken: {client_ip}:{client_port} -> {server_ip}:{server_port}")
+            console_print(f"[-] Connection broken: {client_ip}:{client_port} -> {server_ip}:{server_port}")
         elif e.errno == 54:  # Errno 54 is "Connection reset by peer"
-            print(f"[-] Disconnected from server: {client_ip}:{client_port} -> {server_ip}:{server_port}")
+            console_print(f"[-] Disconnected from server: {client_ip}:{client_port} -> {server_ip}:{server_port}")
         else:
-            print(f"Error in connection: {e}")
+            console_print(f"Error in connection: {e}")
+        counters.incr('connection_errors')
     except Exception as e:
-        print(f"Error in connection: {e}")
+        console_print(f"Error in connection: {e}")
+        counters.incr('connection_errors')
     finally:
+        selector.close()
+        if server_context:
+            # TLS 1.3 tickets only arrive after the handshake, keep the freshest session for the next connection
+            save_tls_session((target_host, target_port), forward_socket)
         for sock in sockets:
             sock.close()
+        for direction in directions:
+            if direction.pipe:
+                os.close(direction.pipe[0])
+                os.close(direction.pipe[1])
+        # Modules log each connection to its own file, write it out now rather than on the next timer
+        close_log(client_ip, client_port, server_ip, server_port)
+        if capture:
+            capture.close()
+        counters.incr('connections_closed')
+
+def start_proxy(listen_host, listen_port, target_host, target_port, use_tls_client, use_tls_server, certfile, keyfile, client_certfile, client_keyfile, cipher, ssl_version, no_verify=False, reuse_port=False):
+    global upstream_executor
 
-def start_proxy(listen_host, listen_port, target_host, target_port, use_tls_client, use_tls_server, certfile, keyfile, client_certfile, client_keyfile, cipher, ssl_version, no_verify=False):
     # Create a socket to listen on
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Let every worker process bind the same port, the kernel spreads connections between them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((listen_host, listen_port))
-    server_socket.listen(5)
+    server_socket.listen(options.backlog)
+
+    # Build the TLS contexts once, every connection shares them (and the server side's session cache)
+    server_context = create_server_context(cipher, ssl_version, client_certfile, client_keyfile, no_verify) if use_tls_server else None
+    client_context = create_client_context(certfile, keyfile) if use_tls_client else None
+    if client_context:
+        # As many threads as handlers, so a slow upstream never holds up another connection's setup; started on demand
+        upstream_executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.max_connections, thread_name_prefix='upstream')
+
+    upstream_pool = None
+    if options.pool_size:
+        upstream_pool = UpstreamPool(options.pool_size, target_host, target_port, server_context, options.pool_max_idle)
     
+    admission = Admission(options.max_connections, options.max_queue, options.max_per_ip)
+    handlers = HandlerPool(options.max_connections)
+
     print(f"[+] Listening on: {listen_host}:{listen_port}")
 
     while True:
-        client_socket, addr = server_socket.accept()
-        client_ip, client_port = client_socket.getpeername()
-        print(f"[+] New server socket thread started for {client_ip}:{client_port}")
-        # Start a new thread for each client connection
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, target_host, target_port, use_tls_client, use_tls_server, certfile, keyfile, cipher, ssl_version, client_certfile, client_keyfile, no_verify))
-        client_thread.start()
+        try:
+            client_socket, addr = server_socket.accept()
+        except OSError as e:
+            # Usually out of file descriptors, back off instead of spinning on the same error
+            console_print(f"Error accepting connection: {e}")
+            counters.incr('accept_errors')
+            time.sleep(0.1)
+            continue
+        counters.incr('connections_accepted')
+        client_ip, client_port = addr[:2]
+        if not admission.admit(client_ip):
+            reject_connection(client_socket, client_ip, client_port)
+            continue
+        console_print(f"[+] New server socket thread started for {client_ip}:{client_port}")
+        # Hand the connection to the handler pool, it waits in the queue while every handler is busy
+        handlers.submit(serve_client, admission, client_ip, client_socket, target_host, target_port, client_context, server_context, upstream_pool)
+
+class AsyncSideProtocol(asyncio.BufferedProtocol):
+    # One end (client or server) of a proxied connection in the asyncio engine
+
+    def __init__(self, session, side):
+        self.session = session
+        self.side = side
+        self.transport = None
+        self.tls = False
+        self.receive_buffer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        self.receive_buffer = ReceiveBuffer(options.buffer_size, min(receive_limit(sock) if sock else 65536, options.max_message_size))
+        self.session.side_made(self.side, self)
+
+    def get_buffer(self, sizehint):
+        return self.receive_buffer.view
+
+    def buffer_updated(self, nbytes):
+        data = bytearray(self.receive_buffer.view[:nbytes])
+        self.receive_buffer.update(nbytes)
+        self.session.data_received(self.side, data)
+
+    def eof_received(self):
+        self.session.eof_received(self.side)
+        # Keep plain transports open so the other direction can finish (TLS transports always close)
+        return not self.tls
+
+    def connection_lost(self, exc):
+        self.session.side_lost(self.side)
+
+    def pause_writing(self):
+        # Our write buffer is full, stop reading from the peer until it drains
+        self.session.pause_peer(self.side)
+
+    def resume_writing(self):
+        self.session.resume_peer(self.side)
+
+class AsyncProxySession:
+    # Both ends of one proxied connection driven from the asyncio event loop
+
+    def __init__(self, loop, target_host, target_port, client_context=None, server_context=None, admission=None, slots=None):
+        self.loop = loop
+        self.target_host = target_host
+        self.target_port = target_port
+        self.client_context = client_context
+        self.server_context = server_context
+        self.admission = admission
+        self.slots = slots
+        self.admitted = False
+        self.has_slot = False
+        self.capture = None
+        self.done = {'client': set(), 'server': set()}  # Modules with a once filter that have already run, per direction
+        self.framers = {side: make_framer(getattr(options, f'framer_{side}'), options.max_message_size) for side in ('client', 'server')}
+        self.framers['client'], self.framers['server'] = link_framers(self.framers['client'], self.framers['server'], options.max_message_size)
+        self.protocols = {}
+        self.pending = {'client': [], 'server': []}
+        self.eof = set()
+        self.paused_at = {}
+        self.ready = False
+        self.closed = False
+        self.client_msg_num = 0
+        self.server_msg_num = 0
+        self.client_transforms = has_transformers(loaded_modules_client)
+        self.server_transforms = has_transformers(loaded_modules_server)
+        self.client_ip = self.client_port = self.server_ip = self.server_port = None
+
+    def side_made(self, side, protocol):
+        self.protocols[side] = protocol
+        if side == 'client':
+            self.client_ip, self.client_port = protocol.transport.get_extra_info('peername')[:2]
+            counters.incr('connections_accepted')
+            if self.admission and not self.admission.admit(self.client_ip):
+                self.closed = True
+                reject_connection(protocol.transport, self.client_ip, self.client_port)
+                return
+            self.admitted = self.admission is not None
+            console_print(f"[+] New connection accepted from {self.client_ip}:{self.client_port}")
+            # Hold client data until the upstream connection is ready
+            protocol.transport.pause_reading()
+            self.loop.create_task(self.setup())
+
+    async def setup(self):
+        if self.slots:
+            # Wait here while --max_connections sessions are already running
+            counters.incr('connections_waiting')
+            try:
+                await self.slots.acquire()
+            finally:
+                counters.incr('connections_waiting', -1)
+            self.has_slot = True
+            if self.closed:
+                self.release()
+                return
+        started = time.monotonic_ns()
+        # Connect upstream while the client handshake runs, so setup costs the longer of the two rather than their sum
+        upstream = self.loop.create_task(self.open_upstream())
+        try:
+            if self.client_context:
+                client_protocol = self.protocols['client']
+                client_protocol.transport = await self.start_tls('client', client_protocol, self.client_context, server_side=True)
+            await upstream
+        except Exception as e:
+            upstream.cancel()
+            console_print(f"Error in connection setup: {e}")
+            counters.incr('connection_errors')
+            self.close()
+            return
+        counters.incr('setups')
+        counters.incr('setup_us', (time.monotonic_ns() - started) // 1000)
+        console_print(f"[+] Connected to server: {self.client_ip}:{self.client_port} -> {self.server_ip}:{self.server_port}")
+
+        if self.closed:
+            return
+        if capture_writer:
+            self.capture = CaptureFlow(capture_writer, self.client_ip, self.client_port, self.server_ip, self.server_port)
+        self.ready = True
+        for protocol in self.protocols.values():
+            protocol.transport.set_write_buffer_limits(high=options.high_water, low=options.low_water)
+        for side in ('client', 'server'):
+            for data in self.pending[side]:
+                self.data_received(side, data)
+            self.pending[side] = []
+        self.protocols['client'].transport.resume_reading()
+
+    async def open_upstream(self):
+        started = time.monotonic_ns()
+        addrinfos = await dns_cache.resolve_async(self.target_host, self.target_port)
+        sock = await happy_eyeballs_connect_async(addrinfos, options.connect_timeout, options.connect_delay)
+        _, server_protocol = await self.loop.create_connection(lambda: AsyncSideProtocol(self, 'server'), sock=sock)
+        counters.incr('connects')
+        counters.incr('connect_us', (time.monotonic_ns() - started) // 1000)
+        self.server_ip, self.server_port = server_protocol.transport.get_extra_info('peername')[:2]
+
+        if self.server_context:
+            server_protocol.transport = await self.start_tls('server', server_protocol, self.server_context, server_hostname=self.target_host)
+
+    async def start_tls(self, side, protocol, context, **kwargs):
+        # asyncio cannot offer a saved session to start_tls, so only the handshake time and reuse are recorded here
+        started = time.monotonic_ns()
+        transport = await self.loop.start_tls(protocol.transport, protocol, context, **kwargs)
+        protocol.tls = True
+        counters.incr(f'tls_handshakes_{side}')
+        counters.incr(f'tls_handshake_us_{side}', (time.monotonic_ns() - started) // 1000)
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session_reused:
+            counters.incr(f'tls_resumed_{side}')
+        return transport
+
+    def data_received(self, side, data):
+        if not self.ready:
+            self.pending[side].append(data)
+            return
+        counters.incr(f'bytes_{side}', len(data))
+        framer = self.framers[side]
+        self.deliver(side, framer.feed(data) if framer else [data])
+
+    def deliver(self, side, messages):
+        try:
+            for message in messages:
+                counters.incr(f'messages_{side}')
+                if side == 'client':
+                    self.client_msg_num = self.client_msg_num + 1
+                    process_message(loaded_modules_client, self.client_transforms, self.protocols['server'].transport.write, self.client_msg_num, self.client_ip, self.client_port, self.server_ip, self.server_port, message, self.capture, self.done['client'])
+                else:
+                    self.server_msg_num = self.server_msg_num + 1
+                    process_message(loaded_modules_server, self.server_transforms, self.protocols['client'].transport.write, self.server_msg_num, self.server_ip, self.server_port, self.client_ip, self.client_port, message, self.capture, self.done['server'])
+        except Exception as e:
+            console_print(f"Error in connection: {e}")
+            counters.incr('connection_errors')
+            self.close()
+
+    def flush_framer(self, side):
+        # Whatever the framer still holds goes out as a last, incomplete message
+        framer = self.framers[side]
+        if framer and self.ready and not self.closed and self.peer(side) is not None:
+            self.deliver(side, framer.flush())
+
+    def eof_received(self, side):
+        self.flush_framer(side)
+        self.eof.add(side)
+        peer = self.peer(side)
+        if len(self.eof) == 2 or peer is None:
+            self.close()
+        elif peer.transport.can_write_eof():
+            # Propagate the half-close to the other end
+            peer.transport.write_eof()
+
+    def side_lost(self, side):
+        self.flush_framer(side)
+        self.protocols.pop(side, None)
+        if not self.closed and self.ready:
+            console_print(f"[-] Disconnected: {self.client_ip}:{self.client_port} -> {self.server_ip}:{self.server_port}")
+        self.close()
+
+    def peer(self, side):
+        return self.protocols.get('server' if side == 'client' else 'client')
+
+    def pause_peer(self, side):
+        peer = self.peer(side)
+        if peer is not None and self.ready:
+            peer.transport.pause_reading()
+            self.paused_at[peer.side] = time.monotonic_ns()
+            counters.incr(f'backpressure_events_{peer.side}')
+
+    def resume_peer(self, side):
+        peer = self.peer(side)
+        if peer is not None and self.ready:
+            peer.transport.resume_reading()
+        paused_at = self.paused_at.pop('server' if side == 'client' else 'client', None)
+        if paused_at is not None:
+            counters.incr(f"backpressure_us_{'server' if side == 'client' else 'client'}", (time.monotonic_ns() - paused_at) // 1000)
+
+    def release(self):
+        if self.has_slot:
+            self.slots.release()
+            self.has_slot = False
+
+    def close(self):
+        if not self.closed:
+            counters.incr('connections_closed')
+            if self.ready:
+                close_log(self.client_ip, self.client_port, self.server_ip, self.server_port)
+            if self.capture:
+                self.capture.close()
+            if self.admitted:
+                self.admission.release(self.client_ip)
+        self.closed = True
+        self.release()
+        for protocol in list(self.protocols.values()):
+            protocol.transport.close()
+
+async def start_proxy_async(listen_host, listen_port, target_host, target_port, use_tls_client, use_tls_server, certfile, keyfile, client_certfile, client_keyfile, cipher, ssl_version, no_verify=False, reuse_port=False):
+    loop = asyncio.get_running_loop()
+
+    # Build the TLS contexts once, every connection shares them
+    server_context = create_server_context(cipher, ssl_version, client_certfile, client_keyfile, no_verify) if use_tls_server else None
+    client_context = create_client_context(certfile, keyfile) if use_tls_client else None
+
+    admission = Admission(options.max_connections, options.max_queue, options.max_per_ip)
+    slots = asyncio.Semaphore(options.max_connections)
+
+    def client_protocol_factory():
+        session = AsyncProxySession(loop, target_host, target_port, client_context, server_context, admission, slots)
+        return AsyncSideProtocol(session, 'client')
+
+    server = await loop.create_server(client_protocol_factory, listen_host, listen_port, reuse_address=True, reuse_port=reuse_port, backlog=options.backlog)
+
+    print(f"[+] Listening on: {listen_host}:{listen_port} (asyncio engine)")
+
+    async with server:
+        await server.serve_forever()
+
+def run_proxy(args, reuse_port=False):
+    global observer_pool, offload_pool, capture_writer
+
+    # Started here so each worker process gets its own observer threads and offload processes
+    if args.observer_threads:
+        observer_pool = ObserverPool(args.observer_threads, args.observer_queue)
+    if args.offload_processes and (loaded_modules_client.offloaded or loaded_modules_server.offloaded):
+        offload_pool = OffloadPool(args.offload_processes, args.observer_queue, args.offload_shm)
+        # Registered after the log and console writers, so it runs before they are flushed at exit
+        atexit.register(offload_pool.close)
+    if args.capture_dir:
+        capture_writer = open_capture(args.capture_dir, args.capture_rotate * 1024 * 1024)
+
+    if args.engine == 'asyncio':
+        try:
+            asyncio.run(start_proxy_async(args.listen_host, args.listen_port, args.target_host, args.target_port,
+                                          args.use_tls_client, args.use_tls_server, args.certfile, args.keyfile, args.client_certfile, args.client_keyfile,
+                                          args.cipher, args.ssl_version, args.no_verify, reuse_port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        start_proxy(args.listen_host, args.listen_port, args.target_host, args.target_port,
+                    args.use_tls_client, args.use_tls_server, args.certfile, args.keyfile, args.client_certfile, args.client_keyfile,
+                    args.cipher, args.ssl_version, args.no_verify, reuse_port)
+
+def report_counters(worker_id, stats_queue, parent_pid, interval=1.0):
+    # Periodically ship this worker's counters to the supervising parent
+    while True:
+        time.sleep(interval)
+        if os.getppid() != parent_pid:
+            # The supervisor has gone away, don't linger as an orphan
+            os._exit(0)
+        stats_queue.put((worker_id, os.getpid(), counters.snapshot(), profile_snapshot() if modules_timed() else None))
+
+def run_worker(worker_id, args, stats_queue):
+    global loaded_modules_client, loaded_modules_server
+
+    if args.pin_cpus and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+    # Each worker loads its own copy of the enabled modules
+    loaded_modules_client = load_modules(modules_client_dir, verbose=False)
+    loaded_modules_server = load_modules(modules_server_dir, verbose=False)
+
+    def terminate(signum, frame):
+        # Flush the module logs, console output and a final snapshot to the parent before exiting
+        if offload_pool:
+            offload_pool.close()
+        flush_logs()
+        flush_console()
+        if capture_writer:
+            capture_writer.flush()
+        stats_queue.put((worker_id, os.getpid(), counters.snapshot(), profile_snapshot() if modules_timed() else None))
+        stats_queue.close()
+        stats_queue.join_thread()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    if hasattr(signal, 'SIGUSR1'):
+        # The parent reports the profile for all workers
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    print(f"[+] Worker {worker_id} started (pid {os.getpid()})")
+    threading.Thread(target=report_counters, args=(worker_id, stats_queue, os.getppid()), daemon=True).start()
+    try:
+        run_proxy(args, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+
+def supervise_workers(args):
+    # Fork the workers, restart any that exit and aggregate their counters
+    context = multiprocessing.get_context('fork')
+    stats_queue = context.Queue()
+    workers = {}
+    latest = {}
+    retired = []
+    latest_profiles = {}
+    retired_profiles = []
+    metrics_server = None
+
+    def spawn(worker_id):
+        # A worker forked while the metrics thread runs could inherit a lock that thread holds, so it is paused meanwhile
+        if metrics_server:
+            metrics_server.shutdown()
+        # Daemonic processes can't start children, and a worker's offload processes are its children;
+        # either way the workers are terminated and joined below when the parent stops
+        process = context.Process(target=run_worker, args=(worker_id, args, stats_queue), daemon=not args.offload_processes)
+        process.start()
+        workers[worker_id] = (process, time.monotonic())
+        if metrics_server:
+            threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    # Treat SIGTERM like Ctrl-C so the workers are always shut down with the parent
+    signal.signal(signal.SIGTERM, terminate)
+    if args.profile and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: report_profiles(merge_profiles(retired_profiles + list(latest_profiles.values()))))
+
+    for worker_id in range(args.workers):
+        spawn(worker_id)
+
+    if args.metrics_port:
+        # The parent serves the combined figures of all workers, as of their last report; started once the workers
+        # are forked, so they don't inherit its thread
+        metrics_server = start_metrics_server(args.metrics_host, args.metrics_port, lambda: (merge_snapshots(retired + list(latest.values())), merge_profiles(retired_profiles + list(latest_profiles.values()))))
+
+    last_report = time.monotonic()
+    try:
+        while True:
+            try:
+                worker_id, pid, snapshot, profile = stats_queue.get(timeout=1.0)
+                latest[pid] = snapshot
+                latest_profiles[pid] = profile or {}
+            except queue.Empty:
+                pass
+
+            for worker_id, (process, started) in list(workers.items()):
+                if process.is_alive():
+                    continue
+                print(f"[-] Worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                # Only its counters live on, its gauges and open connections went with it
+                retired.append(retire_snapshot(latest.pop(process.pid, {})))
+                retired_profiles.append(latest_profiles.pop(process.pid, {}))
+                # Back off a little if the worker is dying straight after start
+                if time.monotonic() - started < 1.0:
+                    time.sleep(1.0)
+                spawn(worker_id)
+
+            if args.stats_interval and time.monotonic() - last_report >= args.stats_interval:
+                last_report = time.monotonic()
+                print(f"[+] Stats ({len(workers)} workers): {format_snapshot(merge_snapshots(retired + list(latest.values())))}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process, started in workers.values():
+            process.terminate()
+        for process, started in workers.values():
+            process.join(timeout=5)
+        while True:
+            try:
+                worker_id, pid, snapshot, profile = stats_queue.get(timeout=0.1)
+                latest[pid] = snapshot
+                latest_profiles[pid] = profile or {}
+            except queue.Empty:
+                break
+        print(f"[+] Stats ({len(workers)} workers): {format_snapshot(merge_snapshots(retired + list(latest.values())))}")
+        if args.profile:
+            report_profiles(merge_profiles(retired_profiles + list(latest_profiles.values())), args.profile_json)
+
+def report_profiles(snapshot, json_path=None):
+    # Print the per-module profile table, and write it as JSON when asked
+    print(f"[+] Module profile:\n{format_profiles(snapshot)}", flush=True)
+    if json_path:
+        dump_profiles(snapshot, json_path)
+        print(f"[+] Module profile written to {json_path}")
 
 if __name__ == "__main__":
 
@@ -154,54 +1295,119 @@ if __name__ == "__main__":
     parser.add_argument('--cipher', help='Cipher suite to use for TLS')
     parser.add_argument('--ssl_version', choices=['TLSv1', 'TLSv1.1', 'TLSv1.2'], help='SSL/TLS version to use')
     parser.add_argument('--no_verify', action='store_true', help='Skip TLS certificate verification for server connection (default: False)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='Connection engine: one thread per connection or a single asyncio event loop (default: threads)')
+    parser.add_argument('--no_splice', action='store_true', help='Never splice directions without modules kernel-side (default: False)')
+    parser.add_argument('--buffer_size', type=int, default=4096, help='Initial receive buffer size, grown while reads fill it (default: 4096)')
+    parser.add_argument('--max_buffer_size', type=int, default=0, help='Largest receive buffer size (default: 0, the socket SO_RCVBUF)')
+    parser.add_argument('--max_message_size', type=int, default=1048576, help='Largest message handed to the modules, bigger bursts are split (default: 1048576)')
+    parser.add_argument('--high_water', type=int, default=262144, help='Bytes queued for one side before reading from the other side pauses (default: 262144)')
+    parser.add_argument('--low_water', type=int, default=65536, help='Bytes queued for one side below which reading from the other side resumes (default: 65536)')
+    parser.add_argument('--pool_size', type=int, default=0, help='Idle pre-connected upstream connections to keep ready, threads engine only (default: 0)')
+    parser.add_argument('--pool_max_idle', type=int, default=30, help='Seconds a pooled upstream connection may sit idle before it is replaced (default: 30)')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog of connections waiting to be accepted (default: 128)')
+    parser.add_argument('--max_connections', type=int, default=1024, help='Connections handled at once; in the threads engine the size of the handler thread pool (default: 1024)')
+    parser.add_argument('--max_queue', type=int, default=128, help='Accepted connections that may wait for a free slot before new ones are rejected (default: 128)')
+    parser.add_argument('--max_per_ip', type=int, default=0, help='Connections (running or queued) allowed from one source IP (default: 0, unlimited)')
+    parser.add_argument('--observer_threads', type=int, default=0, help='Threads running observer modules after the data is forwarded, dropping messages when they fall --observer_queue behind (default: 0, run them inline)')
+    parser.add_argument('--observer_queue', type=int, default=1024, help='Messages waiting for each observer thread before new ones are dropped (default: 1024)')
+    parser.add_argument('--offload_processes', type=int, default=0, help='Processes running the observer modules that declare module_offload (default: 0, they run like other observers)')
+    parser.add_argument('--offload_shm', type=int, default=65536, help='Messages of at least this many bytes reach the offload processes through shared memory (default: 65536)')
+    parser.add_argument('--console_rate', type=int, default=0, help='Module and connection messages shown on the console per second, the rest are counted and summarized (default: 0, no limit)')
+    parser.add_argument('--log_only', action='store_true', help='Show no module or connection messages on the console, only write the module logs (default: False)')
+    parser.add_argument('--capture_dir', help='Write the traffic as received and as forwarded to pcapng files in this directory')
+    parser.add_argument('--capture_rotate', type=int, default=100, help='Start a new capture file once the current one reaches this many MB (default: 100)')
+    parser.add_argument('--framer_client', default='none', help='Split client data into whole protocol messages before the modules: none, length:N[:little][:inclusive], delimiter[:HEX], fix, ber or http (default: none)')
+    parser.add_argument('--framer_server', default='none', help='Split server data into whole protocol messages before the modules, same choices as --framer_client (default: none)')
+    parser.add_argument('--profile', action='store_true', help='Time every module call and print a per-module table on shutdown and on SIGUSR1 (default: False)')
+    parser.add_argument('--profile_json', help='Also write the module profile to this JSON file on shutdown')
+    parser.add_argument('--metrics_port', type=int, default=0, help='Serve Prometheus metrics over HTTP on this port (default: 0, off)')
+    parser.add_argument('--metrics_host', default='localhost', help='Host the metrics listener binds to (default: localhost)')
+    parser.add_argument('--dns_ttl', type=int, default=60, help='Seconds a resolved target_host is cached (default: 60, 0 to resolve on every connection)')
+    parser.add_argument('--connect_timeout', type=float, default=10.0, help='Seconds to wait for an upstream connection across all target addresses (default: 10)')
+    parser.add_argument('--connect_delay', type=float, default=0.25, help='Seconds before trying the next target address while earlier attempts are still pending (default: 0.25)')
+    parser.add_argument('--eager_modules', action='store_true', help='Import every enabled module at startup instead of on its first message (default: False)')
+    parser.add_argument('--workers', type=int, default=0, help='Number of worker processes sharing the listen port with SO_REUSEPORT (default: 0, single process)')
+    parser.add_argument('--pin_cpus', action='store_true', help='Pin each worker process to its own CPU core (default: False)')
+    parser.add_argument('--stats_interval', type=int, default=0, help='Seconds between aggregated worker stats reports (default: 0, only on shutdown)')
 
     args = parser.parse_args()
 
     # Set defaults for TLS to be disabled if not specified
-    use_tls_client = args.use_tls_client if args.use_tls_client is not None else False 
-    use_tls_server = args.use_tls_server if args.use_tls_server is not None else False 
+    args.use_tls_client = args.use_tls_client if args.use_tls_client is not None else False
+    args.use_tls_server = args.use_tls_server if args.use_tls_server is not None else False
 
-    print(f"\n[+] Parley v{VERSION} - {TAGLINE}")
+    options = args
+    dns_cache.ttl = args.dns_ttl
+    configure_console(args.console_rate, args.log_only)
 
-    # Define directories using os.path.join for OS agnosticism
-    modules_client_dir = os.path.join("modules_client", "enabled")
-    modules_server_dir = os.path.join("modules_server", "enabled")
+    if args.buffer_size <= 0 or args.max_message_size <= 0:
+        parser.error("--buffer_size and --max_message_size must be positive")
 
-    loaded_modules_client = {}
-    loaded_modules_server = {}
+    if args.pool_size and args.engine != 'threads':
+        parser.error("--pool_size is only supported by the threads engine")
 
-    # Load modules_client - Process data received by the client for the server
-    print("[+] Loading Client Modules...")
-    for filename in sorted(os.listdir(modules_client_dir)):
-        if filename.endswith(".py") and filename != "__init__.py":
-            module_name = filename[:-3]
+    if args.backlog <= 0 or args.max_connections <= 0 or args.max_queue < 0 or args.max_per_ip < 0:
+        parser.error("--backlog and --max_connections must be positive, --max_queue and --max_per_ip must not be negative")
 
-            module_path = os.path.join(modules_client_dir, filename)
+    for side in ('client', 'server'):
+        try:
+            make_framer(getattr(args, f'framer_{side}'), args.max_message_size)
+        except ValueError as e:
+            parser.error(f"--framer_{side}: {e}")
 
-            spec = importlib.util.spec_from_file_location(module_name, module_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
+    if args.profile_json and not args.profile:
+        parser.error("--profile_json requires --profile")
 
-            loaded_modules_client[module_name] = module
+    if args.capture_rotate <= 0:
+        parser.error("--capture_rotate must be positive")
 
-            print(f"\t<-> {module_name} - {module.module_description}")
+    if args.console_rate < 0:
+        parser.error("--console_rate must not be negative")
 
-    # Load modules_server - Process data received by the server for the client
-    print("[+] Loading Server Modules...")
-    for filename in sorted(os.listdir(modules_server_dir)):
-        if filename.endswith(".py") and filename != "__init__.py":
-            module_name = filename[:-3]
+    if args.observer_threads < 0 or args.observer_queue <= 0:
+        parser.error("--observer_threads must not be negative and --observer_queue must be positive")
+
+    if args.offload_processes < 0 or args.offload_shm <= 0:
+        parser.error("--offload_processes must not be negative and --offload_shm must be positive")
+
+    if args.connect_timeout <= 0 or args.connect_delay < 0:
+        parser.error("--connect_timeout must be positive and --connect_delay must not be negative")
+
+    if args.low_water > args.high_water:
+        parser.error("--low_water must not be larger than --high_water")
 
-            module_path = os.path.join(modules_server_dir, filename)
+    if args.workers and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+        parser.error("--workers requires a platform with fork() and SO_REUSEPORT")
 
-            spec = importlib.util.spec_from_file_location(module_name, module_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
+    print(f"\n[+] Parley v{VERSION} - {TAGLINE}")
+
+    # Define directories using os.path.join for OS agnosticism
+    modules_client_dir = os.path.join("modules_client", "enabled")
+    modules_server_dir = os.path.join("modules_server", "enabled")
 
-            loaded_modules_server[module_name] = module
+    try:
+        # Load modules_client - Process data received by the client for the server
+        print("[+] Loading Client Modules...")
+        loaded_modules_client = load_modules(modules_client_dir)
 
-            print(f"\t<-> {module_name} - {module.module_description}")
+        # Load modules_server - Process data received by the server for the client
+        print("[+] Loading Server Modules...")
+        loaded_modules_server = load_modules(modules_server_dir)
+    except ValueError as e:
+        # A malformed module_filter or module_signatures setting
+        print(f"[!] {e}")
+        sys.exit(1)
 
-    start_proxy(args.listen_host, args.listen_port, args.target_host, args.target_port,
-                use_tls_client, use_tls_server, args.certfile, args.keyfile, args.client_certfile, args.client_keyfile,
-                args.cipher, args.ssl_version, args.no_verify)
+    if args.workers:
+        print(f"[+] Starting {args.workers} worker processes")
+        supervise_workers(args)
+    else:
+        # Exit normally on SIGTERM too, so buffered module logs are written out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if args.profile:
+            atexit.register(lambda: report_profiles(profile_snapshot(), args.profile_json))
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: report_profiles(profile_snapshot()))
+        if args.metrics_port:
+            start_metrics_server(args.metrics_host, args.metrics_port, lambda: (counters.snapshot(), profile_snapshot()))
+        run_proxy(args)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'module_libs'))
+
+from message_utils import apply_edits
+
+
+def test_insert_and_replace_at_same_offset_in_either_order():
+    insert, replace = (1, 0, b'X'), (1, 1, b'Z')
+    assert apply_edits(b'abc', [insert, replace]) == b'aXZc'
+    assert apply_edits(b'abc', [replace, insert]) == b'aXZc'
+
+
+def test_insertions_at_same_offset_keep_their_order():
+    assert apply_edits(b'abc', [(1, 0, b'X'), (1, 0, b'Y')]) == b'aXYbc'